@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Offline analysis of soundtest recordings.
+
+soundtest expects a second PC recording the parallel port pulse on one
+input channel and the sound output on another. This reads such a recording
+in fixed size chunks (memory use does not grow with its length), detects
+rising trigger edges and tone onsets from a moving RMS envelope, pairs each
+trigger with the next onset and reports the latency distribution. Given the
+soundtest data file, each logged Timestamp is matched to the nearest
+trigger once the offset and drift between the two PCs' clocks is known, so
+missed or spurious trigger edges only leave those trials unmatched, and the
+scheduling jitter is reported.
+
+    python analyze.py recording.wav [data.csv] [--trigger 0] [--audio 1]
+"""
+from __future__ import division, print_function
+import argparse
+import csv
+import numpy as np
+from triallog import openCsv
+from wavfile import openWav
+
+
+class _Crossings(object):
+    '''Rising threshold crossings across a stream of chunks, ignoring any
+    crossing within a refractory period of the previous one'''
+    def __init__(self, threshold, refractory):
+        super(_Crossings, self).__init__()
+        self.threshold = threshold
+        self.refractory = refractory
+        self._above = False
+        self._last = -refractory
+
+    def feed(self, values, start):
+        above = values > self.threshold
+        before = np.empty_like(above)
+        before[0] = self._above
+        before[1:] = above[:-1]
+        if len(above):
+            self._above = above[-1]
+        edges = []
+        for index in np.flatnonzero(above & ~before) + start:
+            if index - self._last >= self.refractory:
+                edges.append(int(index))
+                self._last = index
+        return edges
+
+
+class _Envelope(object):
+    '''Moving RMS over a window of samples, continuous across chunks'''
+    def __init__(self, window):
+        super(_Envelope, self).__init__()
+        self.kernel = np.ones(window) / window
+        self._tail = np.zeros(window - 1)
+
+    def feed(self, values):
+        squared = np.concatenate((self._tail, np.square(values,
+                                                        dtype=np.float64)))
+        self._tail = squared[len(squared) - len(self._tail):]
+        return np.sqrt(np.convolve(squared, self.kernel, 'valid'))
+
+
+def detect(filename, trigger=0, audio=1, triggerLevel=0.2, audioLevel=-40,
+           window=0.001, refractory=0.02, chunk=2.0):
+    """Sample indices of trigger edges and tone onsets in a recording.
+    triggerLevel is a fraction of full scale, audioLevel is in dB FS"""
+    wav = openWav(filename)
+    raw = wav.raw
+    scale = _scale(wav)
+    gap = int(refractory * wav.rate)
+    edges = _Crossings(triggerLevel, gap)
+    onsets = _Crossings(10 ** (audioLevel / 20), gap)
+    envelope = _Envelope(max(int(window * wav.rate), 1))
+    triggers, tones = [], []
+    step = int(chunk * wav.rate)
+    for start in range(0, wav.frames, step):
+        block = np.asarray(raw[start:start + step], dtype=np.float64)
+        if wav.width == 3:
+            block = _pack24(block)
+        block = block * scale - (128 * scale if wav.width == 1 else 0)
+        triggers += edges.feed(np.abs(block[:, trigger]), start)
+        tones += onsets.feed(envelope.feed(block[:, audio]), start)
+    return np.array(triggers, dtype=np.int64), np.array(tones,
+                                                        dtype=np.int64), \
+        wav.rate
+
+
+def _scale(wav):
+    if wav.floating:
+        return 1.0
+    if wav.width == 3:
+        return 1.0 / 2 ** 31
+    return 1.0 / 2 ** (8 * wav.width - 1)
+
+
+def _pack24(block):
+    block = block.astype(np.int64)
+    packed = (block[..., 0] << 8) | (block[..., 1] << 16) | \
+        (block[..., 2] << 24)
+    return np.where(packed >= 2 ** 31, packed - 2 ** 32, packed).astype(
+        np.float64)
+
+
+def match(triggers, onsets, maxLatency):
+    """Pair each trigger with the first onset following it within
+    maxLatency samples, returns onset indices (-1 where unmatched)"""
+    following = np.searchsorted(onsets, triggers)
+    matched = np.full(len(triggers), -1, dtype=np.int64)
+    valid = following < len(onsets)
+    candidates = onsets[np.minimum(following, len(onsets) - 1)]
+    valid &= candidates - triggers <= maxLatency
+    matched[valid] = candidates[valid]
+    return matched
+
+
+def _nearest(values, targets):
+    """Index of the nearest of sorted values for every target"""
+    right = np.clip(np.searchsorted(values, targets), 1, len(values) - 1)
+    left = right - 1
+    return np.where(np.abs(values[left] - targets) <=
+                    np.abs(values[right] - targets), left, right)
+
+
+def matchTimestamps(stamps, times, tolerance=None, candidates=5):
+    """Match logged timestamps to trigger times on the recording PC's clock,
+    which has an unknown offset and drift. The offset is found from the
+    pairing of one of the first few stamps and triggers that lines up the
+    most stamps, followed along the run and then refined by a linear fit.
+    tolerance defaults to a quarter of the median stamp spacing. Returns
+    the trigger index of every stamp (-1 where unmatched) and the fit of
+    trigger time against stamp"""
+    stamps, times = np.asarray(stamps, float), np.asarray(times, float)
+    matched = np.full(len(stamps), -1, dtype=np.int64)
+    if len(stamps) < 2 or len(times) < 2:
+        return matched, None
+    if tolerance is None:
+        tolerance = np.median(np.diff(stamps)) / 4
+    # Initial offset, checked against the start of the run only so drift
+    # doesn't matter yet
+    head = stamps[:50]
+    best, offset = -1, 0.0
+    for i in range(min(candidates, len(stamps))):
+        for j in range(min(candidates, len(times))):
+            shifted = head + times[j] - stamps[i]
+            count = (np.abs(times[_nearest(times, shifted)] - shifted) <=
+                     tolerance).sum()
+            if count > best:
+                best, offset = count, times[j] - stamps[i]
+    # Follow the offset along the run as the clocks drift apart
+    for k, stamp in enumerate(stamps):
+        j = _nearest(times, np.array([stamp + offset]))[0]
+        if abs(times[j] - stamp - offset) <= tolerance:
+            matched[k] = j
+            offset = times[j] - stamp
+    found = matched >= 0
+    if found.sum() < 2:
+        return matched, None
+    fit = np.polyfit(stamps[found], times[matched[found]], 1)
+    # Match again against the fit, each trigger to its closest stamp only
+    predicted = np.polyval(fit, stamps)
+    nearest = _nearest(times, predicted)
+    error = np.abs(times[nearest] - predicted)
+    matched[:] = -1
+    taken = set()
+    for k in np.argsort(error):
+        if error[k] > tolerance:
+            break
+        if nearest[k] not in taken:
+            matched[k] = nearest[k]
+            taken.add(nearest[k])
+    found = matched >= 0
+    if found.sum() >= 2:
+        fit = np.polyfit(stamps[found], times[matched[found]], 1)
+    return matched, fit
+
+
+def readTimestamps(filename):
+    """Timestamp column of a soundtest data file"""
+    with open(filename) as f:
+        return np.array([float(row['Timestamp']) for row in csv.DictReader(f)
+                         if row.get('Timestamp') not in (None, '')])
+
+
+def _percentiles(values):
+    if not len(values):
+        return dict(n=0)
+    p = np.percentile(values, [0, 5, 50, 95, 100])
+    return dict(n=len(values), mean=values.mean(), sd=values.std(),
+                min=p[0], p5=p[1], median=p[2], p95=p[3], max=p[4])
+
+
+def analyze(recording, datafile=None, maxLatency=0.1, **detectArgs):
+    """Detect, match and summarise, returns a per trial table and summaries
+    of the latencies and, with a data file, of the scheduling jitter"""
+    triggers, onsets, rate = detect(recording, **detectArgs)
+    matched = match(triggers, onsets, int(maxLatency * rate))
+    latency = np.where(matched >= 0, (matched - triggers) / rate, np.nan)
+    trials = dict(Trigger=triggers / rate, Onset=np.where(
+        matched >= 0, matched / rate, np.nan), Latency=latency)
+    summary = dict(triggers=len(triggers), onsets=len(onsets),
+                   latency=_percentiles(latency[~np.isnan(latency)]))
+    if datafile is not None:
+        stamps = readTimestamps(datafile)
+        matched, fit = matchTimestamps(stamps, trials['Trigger'])
+        found = matched >= 0
+        if fit is not None:
+            # Trigger time less the time expected from the logged stamp,
+            # with the clock offset and drift between the two PCs removed
+            trials['Timestamp'] = np.full(len(triggers), np.nan)
+            trials['Timestamp'][matched[found]] = stamps[found]
+            trials['Jitter'] = trials['Trigger'] - np.polyval(
+                fit, trials['Timestamp'])
+            summary['jitter'] = _percentiles(
+                trials['Jitter'][matched[found]])
+        summary['timestamps'] = len(stamps)
+        summary['unmatchedTimestamps'] = int((~found).sum())
+        summary['unmatchedTriggers'] = len(triggers) - int(found.sum())
+    return trials, summary
+
+
+def _report(summary):
+    print('Triggers: {triggers}, onsets: {onsets}'.format(**summary))
+    if 'timestamps' in summary:
+        print('Timestamps: {timestamps}, unmatched: {unmatchedTimestamps}, '
+              'triggers without a timestamp: {unmatchedTriggers}'.format(
+                  **summary))
+    for name in ('latency', 'jitter'):
+        stats = summary.get(name)
+        if not stats:
+            continue
+        if not stats['n']:
+            print('{}: nothing matched'.format(name.title()))
+            continue
+        print('{} (ms, n={n}): mean {mean:.3f}, sd {sd:.3f}, min {min:.3f}, '
+              'median {median:.3f}, 95% {p95:.3f}, max {max:.3f}'.format(
+                  name.title(), **dict((key, value * 1e3 if key != 'n'
+                                        else value)
+                                       for key, value in stats.items())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('recording')
+    parser.add_argument('datafile', nargs='?')
+    parser.add_argument('--trigger', type=int, default=0,
+                        help='channel with the port pulse')
+    parser.add_argument('--audio', type=int, default=1,
+                        help='channel with the sound output')
+    parser.add_argument('--trigger-level', type=float, default=0.2)
+    parser.add_argument('--audio-level', type=float, default=-40,
+                        help='onset threshold in dB FS')
+    parser.add_argument('--max-latency', type=float, default=0.1)
+    parser.add_argument('--output', help='per trial csv')
+    args = parser.parse_args(argv)
+    trials, summary = analyze(args.recording, args.datafile,
+                              maxLatency=args.max_latency,
+                              trigger=args.trigger, audio=args.audio,
+                              triggerLevel=args.trigger_level,
+                              audioLevel=args.audio_level)
+    _report(summary)
+    output = args.output or args.recording.rsplit('.', 1)[0] + \
+        '_latency.csv'
+    columns = [c for c in ('Trigger', 'Onset', 'Latency', 'Timestamp',
+                           'Jitter')
+               if c in trials]
+    with openCsv(output) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(zip(*[trials[c] for c in columns]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep of sound.init settings: sample rate x buffer size x audio backend.
+
+Each combination runs in its own process, as psychopy picks its audio
+library when psychopy.sound is first imported. A short tone is played on a
+fixed schedule through the TrialScheduler and for every combination the
+time spent in the play call and the scheduling jitter (actual minus
+planned start) are recorded. Results are written as a csv comparison
+report.
+
+With --probe the sounddevice rows also get the output underruns and
+callback period jitter of a separate silent sounddevice stream opened with
+the same rate and buffer. That is a probe of the host audio path, not the
+stream psychopy plays on, so it is not recorded for pyo or pygame, and it
+can't be used with devices that only allow one stream (ASIO, ALSA hw).
+
+With --null no sound card is needed: sounddevice and pyo use the ALSA null
+device and pygame the SDL dummy driver, so the sweep can run in CI.
+
+    python audiobench.py --null --rates 44100 48000 --buffers 128 256 512
+"""
+from __future__ import division, print_function
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import threading
+import numpy as np
+from triallog import openCsv
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+
+BACKENDS = ['sounddevice', 'pyo', 'pygame']
+COLUMNS = ['Backend', 'Rate', 'Buffer', 'Status', 'PlayMedian_ms',
+           'PlayMax_ms', 'JitterMedian_ms', 'JitterP95_ms', 'JitterMax_ms',
+           'ProbeUnderruns', 'ProbeCallbacks', 'ProbeCallbackJitter_ms']
+NULL_DEVICE = 'null'
+
+
+class _TimedAudio(object):
+    '''PsychopyAudio that also times every play call'''
+    def __init__(self, audio):
+        super(_TimedAudio, self).__init__()
+        self.audio = audio
+        self.calls = []
+
+    def play(self, stimulus):
+        start = monotonic()
+        duration = self.audio.play(stimulus)
+        self.calls.append(monotonic() - start)
+        return duration
+
+
+class _StreamProbe(object):
+    '''Silent sounddevice output stream counting underruns and timing its
+    callbacks'''
+    def __init__(self, rate, buffer, device=None):
+        super(_StreamProbe, self).__init__()
+        import sounddevice
+        self.underruns = 0
+        self.times = []
+        self._lock = threading.Lock()
+        self.stream = sounddevice.OutputStream(
+            samplerate=rate, blocksize=buffer, channels=2, device=device,
+            callback=self._callback)
+        self.period = buffer / rate
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time, status):
+        outdata.fill(0)
+        with self._lock:
+            self.times.append(monotonic())
+            if status.output_underflow:
+                self.underruns += 1
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+        intervals = np.diff(self.times)
+        jitter = np.abs(intervals - self.period).max() if len(intervals) \
+            else np.nan
+        return dict(ProbeUnderruns=self.underruns,
+                    ProbeCallbacks=len(self.times),
+                    ProbeCallbackJitter_ms=jitter * 1e3)
+
+
+def measure(backend, rate, buffer, device=None, trials=50, interval=0.1,
+            tone=0.05, probe=False):
+    """Run one combination in this process, returns a report row. probe
+    opens a _StreamProbe alongside the sounddevice backend"""
+    from psychopy import prefs
+    prefs.general['audioLib'] = [backend]
+    if device is not None:
+        prefs.general['audiodevice'] = device
+    from psychopy import sound
+    from scheduler import TrialScheduler, MockPort, PsychopyAudio
+    from tonebank import ToneBank
+    sound.init(rate=rate, stereo=True, buffer=buffer)
+    if sound.audioLib != backend:
+        raise RuntimeError('{} unavailable, psychopy loaded {}'.format(
+            backend, sound.audioLib))
+    waveform = ToneBank(rate=rate).build([1000], [tone])[0]
+    stimulus = sound.Sound(value=waveform, sampleRate=rate, hamming=False)
+    if probe and backend == 'sounddevice':
+        try:
+            probe = _StreamProbe(rate, buffer, device)
+        except Exception:  # the device may only allow one stream
+            probe = None
+    else:
+        probe = None
+    audio = _TimedAudio(PsychopyAudio())
+    scheduler = TrialScheduler(MockPort(), audio)
+    start = scheduler.clock() + 0.2
+    planned = start + interval * np.arange(trials)
+    presented = [scheduler.playTrial(stimulus, when=when) for when in planned]
+    for trial in presented:
+        trial.wait()
+    scheduler.close()
+    jitter = np.abs(np.array([trial.played for trial in presented]) - planned)
+    calls = np.array(audio.calls)
+    row = dict(Backend=backend, Rate=rate, Buffer=buffer, Status='ok',
+               PlayMedian_ms=np.median(calls) * 1e3,
+               PlayMax_ms=calls.max() * 1e3,
+               JitterMedian_ms=np.median(jitter) * 1e3,
+               JitterP95_ms=np.percentile(jitter, 95) * 1e3,
+               JitterMax_ms=jitter.max() * 1e3)
+    if probe is not None:
+        row.update(probe.close())
+    return row
+
+
+def _child(argv):
+    """Entry point of the per combination subprocess, prints the row as
+    json on the last line of stdout"""
+    backend, rate, buffer, device, trials, probe = argv
+    row = measure(backend, int(rate), int(buffer), device or None,
+                  int(trials), probe=probe == 'probe')
+    print(json.dumps(dict((key, float(value) if isinstance(
+        value, np.floating) else value) for key, value in row.items())))
+
+
+def sweep(backends, rates, buffers, device=None, null=False, trials=50,
+          timeout=120, probe=False):
+    """Measure every combination in a fresh process, failures are reported
+    in the Status column rather than stopping the sweep"""
+    rows = []
+    env = dict(os.environ)
+    if null:
+        env['SDL_AUDIODRIVER'] = 'dummy'
+        device = device or NULL_DEVICE
+    for backend in backends:
+        for rate in rates:
+            for buffer in buffers:
+                command = [sys.executable, os.path.abspath(__file__),
+                           '--child', backend, str(rate), str(buffer),
+                           device or '', str(trials),
+                           'probe' if probe else '']
+                process = subprocess.Popen(command, env=env,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           universal_newlines=True)
+                timer = threading.Timer(timeout, process.kill)
+                timer.start()
+                out, err = process.communicate()
+                timer.cancel()
+                lines = out.strip().splitlines()
+                if process.returncode == 0 and lines:
+                    row = json.loads(lines[-1])
+                else:
+                    reason = (err.strip().splitlines() or
+                              ['exit code {}'.format(process.returncode)])
+                    row = dict(Backend=backend, Rate=rate, Buffer=buffer,
+                               Status='failed: ' + reason[-1])
+                rows.append(row)
+                _show(row)
+    return rows
+
+
+def _show(row):
+    if row['Status'] != 'ok':
+        print('{Backend:<12}{Rate:>7}{Buffer:>6}  {Status}'.format(**row))
+        return
+    print('{Backend:<12}{Rate:>7}{Buffer:>6}  play {PlayMedian_ms:.3f}/'
+          '{PlayMax_ms:.3f} ms  jitter {JitterMedian_ms:.3f}/'
+          '{JitterP95_ms:.3f}/{JitterMax_ms:.3f} ms{}'.format(
+              '  probe underruns {}'.format(row['ProbeUnderruns'])
+              if 'ProbeUnderruns' in row else '', **row))
+
+
+def writeReport(filename, rows):
+    with openCsv(filename) as f:
+        writer = csv.DictWriter(f, COLUMNS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--child']:
+        return _child(argv[1:])
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backends', nargs='+', default=BACKENDS,
+                        choices=BACKENDS)
+    parser.add_argument('--rates', nargs='+', type=int,
+                        default=[44100, 48000])
+    parser.add_argument('--buffers', nargs='+', type=int,
+                        default=[64, 128, 256, 512, 1024])
+    parser.add_argument('--device', help='psychopy audio device name')
+    parser.add_argument('--null', action='store_true',
+                        help='use null devices, no sound card needed')
+    parser.add_argument('--trials', type=int, default=50)
+    parser.add_argument('--output', default='audiobench.csv')
+    parser.add_argument('--max-jitter', type=float,
+                        help='fail if any 95th percentile jitter (ms) is '
+                        'above this')
+    parser.add_argument('--probe', action='store_true',
+                        help='also time a silent sounddevice stream')
+    args = parser.parse_args(argv)
+    rows = sweep(args.backends, args.rates, args.buffers, args.device,
+                 args.null, args.trials, probe=args.probe)
+    writeReport(args.output, rows)
+    failed = [row for row in rows if row['Status'] != 'ok' or
+              args.max_jitter is not None and
+              row['JitterP95_ms'] > args.max_jitter]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
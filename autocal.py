@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Automated closed-loop calibration against a sound level meter.
+
+A meter backend reports the level of the sound being played and the
+AutoCalibrator searches for the volume reaching each sound's dB target,
+using secant steps on level against gain in dB and falling back to
+bisection whenever a step would leave the bracketing interval.
+"""
+from __future__ import division
+import abc
+import math
+import random
+import re
+from time import sleep
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+
+
+def _energyMean(levels):
+    """Average dB readings in the power domain"""
+    return 10 * math.log10(sum(10 ** (level / 10) for level in levels) /
+                           len(levels))
+
+
+# abc.ABC for python 2 and 3
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+class SPLMeter(_ABC):
+    '''Meter backend, subclasses implement read. needsPlayback is False
+    for meters that don't listen to the sound card'''
+    needsPlayback = True
+
+    @abc.abstractmethod
+    def read(self, duration, stimulus=None):
+        """Level in dB SPL averaged over duration seconds while stimulus
+        is playing"""
+
+    def close(self):
+        """Release the device, nothing to do by default"""
+
+
+class SerialMeter(SPLMeter):
+    '''Sound level meter streaming one reading per line over a serial port'''
+    def __init__(self, port, baudrate=9600,
+                 pattern=r'(-?\d+(?:\.\d+)?)'):
+        super(SerialMeter, self).__init__()
+        import serial  # pyserial is only needed for this backend
+        self.serial = serial.Serial(port, baudrate, timeout=1)
+        self.pattern = re.compile(pattern)
+
+    def read(self, duration, stimulus=None):
+        self.serial.reset_input_buffer()
+        levels = []
+        end = monotonic() + duration
+        while monotonic() < end or not levels:
+            line = self.serial.readline().decode('ascii', 'ignore')
+            if not line:
+                raise IOError('No reading from meter on ' + self.serial.port)
+            match = self.pattern.search(line)
+            if match:
+                levels.append(float(match.group(1)))
+        return _energyMean(levels)
+
+    def close(self):
+        self.serial.close()
+
+
+class InputMeter(SPLMeter):
+    '''RMS level of a calibrated microphone on an audio input device.
+    offset is the dB SPL of a full scale (RMS 1.0) input, found with a
+    reference calibrator'''
+    def __init__(self, offset, device=None, rate=48000):
+        super(InputMeter, self).__init__()
+        import sounddevice  # only needed for this backend
+        self.sounddevice = sounddevice
+        self.offset = offset
+        self.device = device
+        self.rate = rate
+
+    def read(self, duration, stimulus=None):
+        import numpy as np
+        recording = self.sounddevice.rec(int(duration * self.rate),
+                                         samplerate=self.rate, channels=1,
+                                         device=self.device, dtype='float32')
+        self.sounddevice.wait()
+        rms = np.sqrt(np.mean(np.square(recording, dtype=np.float64)))
+        return self.offset + 20 * math.log10(max(rms, 1e-12))
+
+
+class SimulatedMeter(SPLMeter):
+    '''Meter for testing without hardware. The level is sensitivity plus
+    the gain of the stimulus volume, an optional per stimulus response
+    offset and gaussian noise'''
+    needsPlayback = False
+
+    def __init__(self, sensitivity=100.0, response=None, noise=0.0,
+                 seed=None):
+        super(SimulatedMeter, self).__init__()
+        self.sensitivity = sensitivity
+        self.response = response
+        self.noise = noise
+        self.random = random.Random(seed)
+
+    def read(self, duration, stimulus=None):
+        level = self.sensitivity + 20 * math.log10(max(stimulus.volume,
+                                                       1e-12))
+        if self.response is not None:
+            level += self.response(stimulus)
+        return level + self.random.gauss(0, self.noise)
+
+
+def makeMeter(description):
+    """Create a meter from a command line description:
+    simulated[:sensitivity[:noise[:seed]]], serial:<port>[:baudrate] or
+    input:<offset>[:device[:rate]], device is a name or an index"""
+    kind, _, args = description.partition(':')
+    args = args.split(':') if args else []
+    if kind == 'simulated':
+        names = ['sensitivity', 'noise', 'seed']
+        types = [float, float, int]
+        return SimulatedMeter(**dict((name, convert(arg)) for name, convert,
+                                     arg in zip(names, types, args)))
+    if kind == 'serial':
+        return SerialMeter(args[0], *[int(arg) for arg in args[1:]])
+    if kind == 'input':
+        device = args[1] if len(args) > 1 and args[1] else None
+        if device is not None and device.isdigit():
+            device = int(device)
+        rate = int(args[2]) if len(args) > 2 else 48000
+        return InputMeter(float(args[0]), device=device, rate=rate)
+    raise ValueError('Unknown meter: ' + description)
+
+
+class AutoCalibrator(object):
+    '''Finds the volume at which a sound reaches its dB target'''
+    def __init__(self, meter, tolerance=0.25, maxSteps=12, settle=0.1,
+                 duration=0.5, minVolume=1e-4, maxVolume=1.0):
+        super(AutoCalibrator, self).__init__()
+        self.meter = meter
+        self.tolerance = tolerance
+        self.maxSteps = maxSteps
+        self.settle = settle
+        self.duration = duration
+        self.minVolume = minVolume
+        self.maxVolume = maxVolume
+        self.minGain = 20 * math.log10(minVolume)
+        self.maxGain = 20 * math.log10(maxVolume)
+
+    def measure(self, stimulus, gain):
+        """Play stimulus looped at gain (dB re full volume), return its
+        level"""
+        stimulus.volume = 10 ** (gain / 20)
+        if not self.meter.needsPlayback:
+            return self.meter.read(self.duration, stimulus)
+        snd = stimulus.sound
+        snd.play(loops=-1)
+        try:
+            sleep(self.settle)
+            return self.meter.read(self.duration, stimulus)
+        finally:
+            snd.stop()
+
+    def calibrate(self, stimulus, volume=0.4):
+        """Search for the volume reaching stimulus.target, returns the volume,
+        its measured level, the number of presentations used and whether the
+        level is within tolerance of the target. It isn't when the target is
+        out of reach of the volume range or maxSteps ran out"""
+        target = float(stimulus.target)
+        low, high = self.minGain, self.maxGain
+        volume = min(max(volume, self.minVolume), self.maxVolume)
+        gain = 20 * math.log10(volume)
+        level = self.measure(stimulus, gain)
+        presentations = 1
+        slope = 1.0  # dB of level per dB of gain for a linear system
+        while presentations < self.maxSteps:
+            error = target - level
+            if abs(error) <= self.tolerance:
+                break
+            # Keep the interval known to contain the target
+            if error > 0:
+                low = max(low, gain)
+            else:
+                high = min(high, gain)
+            if error > 0 and gain >= self.maxGain or \
+                    error < 0 and gain <= self.minGain:
+                break  # target out of reach of the volume range
+            nextGain = min(max(gain + error / slope, self.minGain),
+                           self.maxGain)
+            limit = nextGain in (self.minGain, self.maxGain)
+            if nextGain == gain or not (low < nextGain < high or limit):
+                nextGain = (low + high) / 2
+            if nextGain == gain:
+                break  # bracket has collapsed
+            nextLevel = self.measure(stimulus, nextGain)
+            presentations += 1
+            secant = (nextLevel - level) / (nextGain - gain)
+            slope = secant if secant > 0.1 else 1.0
+            gain, level = nextGain, nextLevel
+        converged = abs(target - level) <= self.tolerance
+        return 10 ** (gain / 20), level, presentations, converged
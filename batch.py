@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Non-interactive command line entry point for calibration and sound tests.
+
+Spec files are pre-rendered, and wav files decoded, quality checked and
+cached in parallel with a process pool before any hardware session starts,
+so the session itself only loads cached waveforms. Targets (calibration) or
+repeat counts (sound test) for wav files come from a csv with File, Target
+and Repeats columns instead of dialogs.
+
+    python batch.py prepare specs/*.csv [--jobs 4]
+    python batch.py calibrate specs/*.csv tones.wav --targets targets.csv \\
+        --meter simulated --outdir runs/today
+    python batch.py soundtest specs/*.csv --compiled --headless
+"""
+from __future__ import division, print_function
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+from specfile import loadSpec, SpecError
+from stimuli import SoundFromFile, StimulusTable
+from stimqa import checkStimuli, problems, writeReport
+from wavecache import WaveformCache
+
+_thisDir = os.path.dirname(os.path.abspath(__file__))
+cacheDir = os.path.join(_thisDir, 'data', 'cache')
+
+
+def _prepare(job):
+    """Render or decode, check and cache one spec or wav file, run in a
+    pool worker"""
+    filename, rate, outdir = job
+    cache = WaveformCache(cacheDir)
+    try:
+        if filename[-3:] == 'csv':
+            table = StimulusTable([loadSpec(filename)], rate=rate)
+        else:
+            table = StimulusTable(files=[SoundFromFile(filename)], rate=rate)
+            snd = table.files[0]
+            cache.put(snd.cacheKey(), snd.load())
+    except (SpecError, IOError, ValueError) as e:
+        return filename, 0, [('', str(e))]
+    table.render(cache)
+    qa = checkStimuli(table)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    writeReport(os.path.join(outdir, name + '_qa.csv'), qa)
+    return filename, len(table), problems(qa)
+
+
+def prepare(files, rate=48000, outdir=None, jobs=None):
+    """Pre-render or decode, check and cache spec and wav files in
+    parallel, returns the number of files that failed to load or have
+    stimuli failing QA"""
+    outdir = outdir or os.path.join(_thisDir, 'data')
+    if not files:
+        return 0
+    pool = multiprocessing.Pool(jobs or min(len(files),
+                                            multiprocessing.cpu_count()))
+    failed = 0
+    try:
+        for filename, count, issues in pool.imap_unordered(
+                _prepare, [(f, rate, outdir) for f in files]):
+            print('{}: {} stimuli, {} with problems'.format(
+                filename, count, len(issues)))
+            for name, issue in issues:
+                print('    {} {}'.format(name, issue))
+            failed += bool(issues)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def readTargets(filename):
+    """File -> (target, repeats) from a targets csv, files are matched by
+    path as given and by base name"""
+    targets = {}
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            entry = (row.get('Target', ''), row.get('Repeats') or 1)
+            targets[row['File']] = entry
+            targets.setdefault(os.path.basename(row['File']), entry)
+    return targets
+
+
+def _lookup(targets, wavfiles, column):
+    found = {}
+    for f in wavfiles:
+        entry = targets.get(f, targets.get(os.path.basename(f)))
+        if entry is None:
+            sys.exit('No entry for {} in the targets csv'.format(f))
+        found[f] = entry[column]
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['prepare', 'calibrate',
+                                            'soundtest'])
+    parser.add_argument('files', nargs='+', help='spec csv and wav files')
+    parser.add_argument('--targets', help='csv of File, Target, Repeats')
+    parser.add_argument('--outdir', help='data directory (default data/)')
+    parser.add_argument('--rate', type=int, default=48000)
+    parser.add_argument('--buffer', type=int, default=256)
+    parser.add_argument('--device', help='psychopy audio device name')
+    parser.add_argument('--jobs', type=int,
+                        help='prepare processes (default one per cpu)')
+    parser.add_argument('--no-prepare', action='store_true')
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--meter', help='SPL meter backend, see autocal')
+    parser.add_argument('--sparse', type=int)
+    parser.add_argument('--per-ear', action='store_true',
+                        help='calibrate left and right separately')
+    parser.add_argument('--compiled', action='store_true')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record per phase sound test timing')
+    parser.add_argument('--mock-port', action='store_true',
+                        help='log sound test port codes instead of sending')
+    args = parser.parse_args(argv)
+    wavfiles = [f for f in args.files if f[-3:] != 'csv']
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    if args.command == 'prepare' or not args.no_prepare:
+        failed = prepare(args.files, args.rate, args.outdir, args.jobs)
+        if args.command == 'prepare':
+            return 1 if failed else 0
+    targets = readTargets(args.targets) if args.targets else {}
+    session = dict(headless=args.headless, filelist=args.files,
+                   rate=args.rate, buffer=args.buffer, device=args.device,
+                   outdir=args.outdir)
+    # Imported late as these configure psychopy and open the sound card
+    if args.command == 'calibrate':
+        from soundcal import Calibration
+        from autocal import makeMeter
+        exp = Calibration(resume=args.resume, perEar=args.per_ear,
+                          targets=_lookup(targets, wavfiles, 0), **session)
+        exp.run(meter=makeMeter(args.meter) if args.meter else None,
+                sparse=args.sparse)
+    else:
+        from soundtest import SoundTest
+        exp = SoundTest(repeats=_lookup(targets, wavfiles, 1),
+                        instrument=args.instrument,
+                        mockPort=args.mock_port, **session)
+        exp.run(compiled=args.compiled)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
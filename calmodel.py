@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration curve model for predicting volumes of unmeasured stimuli.
+
+Playing a tone of frequency f and duration d at volume v gives a level of
+offset(f, d) + 20 log10(v) dB. The offset is modelled as a low order
+polynomial surface in log frequency and log duration, fitted by least
+squares to the marked volumes, so the volume for any frequency, duration
+and target can be predicted. The model's prediction variance also tells
+which grid points would add the most information if measured next.
+"""
+from __future__ import division
+import numpy as np
+
+
+class CalibrationModel(object):
+    '''Polynomial dB offset surface over log frequency and log duration'''
+    def __init__(self, freqs, durs, degree=2, ridge=1e-6):
+        """freqs and durs describe the full stimulus grid, used to scale the
+        model inputs"""
+        super(CalibrationModel, self).__init__()
+        logf, logd = np.log(freqs), np.log(durs)
+        self.centre = np.array([logf.mean(), logd.mean()])
+        self.scale = np.array([np.ptp(logf) or 1.0, np.ptp(logd) or 1.0])
+        self.powers = [(i, j) for i in range(degree + 1)
+                       for j in range(degree + 1 - i)]
+        self.ridge = ridge
+        self.coef = None
+        self.residual = None
+
+    def design(self, freqs, durs):
+        """Design matrix with one column per polynomial term"""
+        x = (np.log(freqs) - self.centre[0]) / self.scale[0]
+        y = (np.log(durs) - self.centre[1]) / self.scale[1]
+        return np.column_stack([x ** i * y ** j for i, j in self.powers])
+
+    def _information(self, X):
+        return X.T.dot(X) + self.ridge * np.eye(len(self.powers))
+
+    def fit(self, freqs, durs, targets, volumes):
+        """Fit the offset surface to measured (frequency, duration, target,
+        volume) points"""
+        X = self.design(freqs, durs)
+        offsets = np.asarray(targets, float) - 20 * np.log10(volumes)
+        self.coef = np.linalg.solve(self._information(X), X.T.dot(offsets))
+        residuals = offsets - X.dot(self.coef)
+        dof = max(len(offsets) - len(self.powers), 1)
+        self.residual = np.sqrt(residuals.dot(residuals) / dof)
+        self._covariance = np.linalg.inv(self._information(X))
+        return self
+
+    def offset(self, freqs, durs):
+        return self.design(freqs, durs).dot(self.coef)
+
+    def predict(self, freqs, durs, targets):
+        """Volume needed to reach each target"""
+        return 10 ** ((np.asarray(targets, float) -
+                       self.offset(freqs, durs)) / 20)
+
+    def uncertainty(self, freqs, durs):
+        """Standard error of the predicted level in dB"""
+        X = self.design(freqs, durs)
+        leverage = np.einsum('ij,jk,ik->i', X, self._covariance, X)
+        return self.residual * np.sqrt(leverage)
+
+    def suggest(self, freqs, durs, measured, count=1):
+        """Indices of the count grid points that add the most information,
+        chosen greedily by prediction variance given the measured points"""
+        X = self.design(freqs, durs)
+        measured = np.asarray(measured, bool).copy()
+        information = self._information(X[measured])
+        chosen = []
+        for _ in range(min(count, int((~measured).sum()))):
+            covariance = np.linalg.inv(information)
+            variance = np.einsum('ij,jk,ik->i', X, covariance, X)
+            variance[measured] = -np.inf
+            best = int(np.argmax(variance))
+            chosen.append(best)
+            measured[best] = True
+            information += np.outer(X[best], X[best])
+        return chosen
+
+    @property
+    def minimumPoints(self):
+        return len(self.powers)
+
+
+def markedPoints(table, marked):
+    """Arrays of frequency, duration, target and mean marked volume for every
+    generated sound of a StimulusTable with at least one mark, marked holds
+    the list of marked volumes of each stimulus id"""
+    grid = table.generated
+    volumes = np.array([np.mean(marked[idx]) if marked[idx] else 0.0
+                        for idx in grid])
+    rows = table.data[grid]
+    keep = (volumes > 0) & ~np.isnan(rows['Target'])
+    return (rows['Frequency'][keep], rows['Duration'][keep],
+            rows['Target'][keep], volumes[keep])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Compact calibration lookup table for use at experiment runtime.
+
+The table file holds sorted target, frequency and duration axes followed by
+a float32 volume grid (NaN where nothing was calibrated), laid out so it can
+be memory-mapped directly. CalTable only needs numpy, not pandas.
+
+Layout (little endian):
+    b'CALT', uint32 version, uint32 nt, nf, nd
+    float64 targets[nt], freqs[nf], durs[nd]
+    float32 volumes[nt, nf, nd]
+"""
+from __future__ import division
+import struct
+import numpy as np
+
+MAGIC = b'CALT'
+VERSION = 1
+_HEADER = struct.Struct('<4sIIII')
+_DIGITS = 9  # axis values are matched after rounding to this many places
+
+
+def writeTable(filename, freqs, durs, targets, volumes):
+    """Write calibrated points (one volume per frequency, duration and
+    target) as a table file"""
+    freqs, durs, targets, volumes = (np.asarray(a, float) for a in
+                                     (freqs, durs, targets, volumes))
+    axes = [np.unique(np.round(a, _DIGITS)) for a in (targets, freqs, durs)]
+    grid = np.full([len(axis) for axis in axes], np.nan, dtype='<f4')
+    index = tuple(np.searchsorted(axis, np.round(a, _DIGITS))
+                  for axis, a in zip(axes, (targets, freqs, durs)))
+    grid[index] = volumes
+    with open(filename, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, *grid.shape))
+        for axis in axes:
+            f.write(axis.astype('<f8').tobytes())
+        f.write(grid.tobytes())
+    return grid
+
+
+class CalTable(object):
+    '''Memory-mapped calibration table with exact and interpolated lookup'''
+    def __init__(self, filename):
+        super(CalTable, self).__init__()
+        with open(filename, 'rb') as f:
+            magic, version, nt, nf, nd = _HEADER.unpack(
+                f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a calibration table: ' + filename)
+        offset = _HEADER.size
+        axes = []
+        for count in (nt, nf, nd):
+            axes.append(np.memmap(filename, dtype='<f8', mode='r',
+                                  offset=offset, shape=(count,)))
+            offset += 8 * count
+        self.targets, self.freqs, self.durs = axes
+        self.volumes = np.memmap(filename, dtype='<f4', mode='r',
+                                 offset=offset, shape=(nt, nf, nd))
+        self._index = [dict((value, i) for i, value in enumerate(
+            np.round(axis, _DIGITS).tolist())) for axis in axes]
+
+    def _target(self, target):
+        if target is None:
+            if len(self.targets) != 1:
+                raise KeyError('Table has several targets, give one')
+            return 0
+        return self._index[0][round(float(target), _DIGITS)]
+
+    def lookup(self, freq, dur, target=None):
+        """Volume calibrated at exactly this grid point, O(1)"""
+        volume = self.volumes[self._target(target),
+                              self._index[1][round(float(freq), _DIGITS)],
+                              self._index[2][round(float(dur), _DIGITS)]]
+        return float(volume)
+
+    def interpolate(self, freq, dur, target=None):
+        """Volume between grid points, bilinear over log frequency and log
+        duration in the dB domain, clamped at the edges of the grid. Only
+        the corners with a weight are used, so grid points and edges work
+        next to uncalibrated holes. Raises ValueError if a corner that is
+        needed wasn't calibrated"""
+        plane = self.volumes[self._target(target)]
+        (fi, fw), (di, dw) = (
+            _bracket(np.log(axis), np.log(round(float(value), _DIGITS)))
+            for axis, value in ((self.freqs, freq), (self.durs, dur)))
+        weights = np.outer(fw, dw)
+        needed = weights > 0
+        corners = plane[np.ix_(fi, di)].astype(float)[needed]
+        if not (corners > 0).all():  # NaN or a zero volume
+            raise ValueError(
+                'No calibrated volume around frequency {}, duration {}, '
+                'target {}'.format(freq, dur, target))
+        level = np.dot(weights[needed], 20 * np.log10(corners))
+        return float(10 ** (level / 20))
+
+
+def _bracket(axis, value):
+    """Indices and weights of the two axis points around value"""
+    if len(axis) == 1:
+        return [0, 0], np.array([1.0, 0.0])
+    upper = int(np.clip(np.searchsorted(axis, value), 1, len(axis) - 1))
+    weight = np.clip((value - axis[upper - 1]) /
+                     (axis[upper] - axis[upper - 1]), 0.0, 1.0)
+    return [upper - 1, upper], np.array([1 - weight, weight])
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Non-spinning keyboard input for the calibration loop.
+
+Key sources block on a queue of (key, pressed, time) events with a timeout
+instead of polling, and the InputDispatcher owns the sound replay timer and
+auto-repeat of held keys. Run this module directly for a microbenchmark of
+CPU use and key-to-action latency against a synthetic event source.
+"""
+from __future__ import division, print_function
+import random
+import sys
+import threading
+from collections import deque
+from time import sleep
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+try:
+    from time import process_time
+except ImportError:  # python 2
+    from time import clock as process_time
+
+
+class QueueKeySource(object):
+    '''Thread-safe source of key events, also used as the synthetic source'''
+    def __init__(self, clock=monotonic):
+        super(QueueKeySource, self).__init__()
+        self.clock = clock
+        self.queue = Queue()
+
+    def press(self, key):
+        self.queue.put((key, True, self.clock()))
+
+    def release(self, key):
+        self.queue.put((key, False, self.clock()))
+
+    def next(self, timeout):
+        """Block for up to timeout seconds for the next event"""
+        try:
+            return self.queue.get(timeout=max(timeout, 0))
+        except Empty:
+            return None
+
+
+class ConsoleKeySource(QueueKeySource):
+    '''Key names typed on the console, read on a background thread. Names
+    not in keys are rejected with a message listing the valid ones'''
+    def __init__(self, keys=None, prompt='key> ', clock=monotonic):
+        super(ConsoleKeySource, self).__init__(clock)
+        self.keys = keys
+        self.prompt = prompt
+        reader = threading.Thread(target=self._read, name='ConsoleKeys')
+        reader.daemon = True
+        reader.start()
+
+    def _read(self):
+        while True:
+            sys.stdout.write(self.prompt)
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            if not line:
+                break
+            key = line.strip()
+            if self.keys is not None and key not in self.keys:
+                print('Unknown key, use one of: ' +
+                      ', '.join(sorted(self.keys)))
+                continue
+            self.press(key)
+            self.release(key)
+        self.press('escape')  # end of input
+
+
+class PygletKeySource(QueueKeySource):
+    '''Key presses and releases from a psychopy (pyglet) window.
+
+    pyglet events have to be dispatched from the main thread, so this
+    sleeps on the queue in short slices between dispatches'''
+    def __init__(self, win, clock=monotonic, slice=0.01):
+        super(PygletKeySource, self).__init__(clock)
+        from pyglet.window import key
+        self._symbol = key.symbol_string
+        self.slice = slice
+        self.winHandle = win.winHandle
+        self.winHandle.push_handlers(on_key_press=self._onPress,
+                                     on_key_release=self._onRelease)
+
+    def _onPress(self, symbol, modifiers):
+        self.press(self._symbol(symbol).lower())
+
+    def _onRelease(self, symbol, modifiers):
+        self.release(self._symbol(symbol).lower())
+
+    def next(self, timeout):
+        end = self.clock() + timeout
+        while True:
+            self.winHandle.dispatch_events()
+            remaining = end - self.clock()
+            event = super(PygletKeySource, self).next(
+                min(self.slice, remaining))
+            if event is not None or remaining <= self.slice:
+                return event
+
+
+class InputDispatcher(object):
+    '''Maps key events to actions, replaying a sound while waiting and
+    auto-repeating held keys, without ever polling'''
+    def __init__(self, source, keymap, replayInterval=1.5, repeatKeys=(),
+                 repeatDelay=0.4, repeatRate=0.1, clock=monotonic):
+        super(InputDispatcher, self).__init__()
+        self.source = source
+        self.keymap = keymap
+        self.replayInterval = replayInterval
+        self.repeatKeys = repeatKeys
+        self.repeatDelay = repeatDelay
+        self.repeatRate = repeatRate
+        self.clock = clock
+        self.latencies = deque(maxlen=1000)
+        self._held = None
+        self._nextRepeat = None
+
+    def wait(self, replay=None):
+        """Block until an action is due and return it, calling replay every
+        replayInterval seconds while waiting"""
+        nextReplay = self.clock() + self.replayInterval
+        while True:
+            due = nextReplay
+            if self._held is not None:
+                due = min(due, self._nextRepeat)
+            event = self.source.next(due - self.clock())
+            now = self.clock()
+            if event is None:
+                if self._held is not None and now >= self._nextRepeat:
+                    self._nextRepeat = now + self.repeatRate
+                    return self.keymap[self._held]
+                if now >= nextReplay:
+                    if replay is not None:
+                        replay()
+                    nextReplay = now + self.replayInterval
+                continue
+            key, pressed, when = event
+            if key not in self.keymap:
+                continue
+            if not pressed:
+                if key == self._held:
+                    self._held = None
+                continue
+            if key in self.repeatKeys:
+                self._held = key
+                self._nextRepeat = now + self.repeatDelay
+            self.latencies.append(self.clock() - when)
+            return self.keymap[key]
+
+
+def _spinningWait(source, keymap):
+    """The old check_keys loop, polling without sleeping, for comparison"""
+    while True:
+        try:
+            key, pressed, when = source.queue.get_nowait()
+        except Empty:
+            continue
+        if pressed and key in keymap:
+            return keymap[key], when
+
+
+def benchmark(presses=50, spacing=0.02, seed=0):
+    """Feed synthetic key presses at random intervals and report the CPU
+    used per wall second and key-to-action latency, both for the
+    dispatcher and for a spinning poll loop"""
+    keys = ['left', 'right', 'up', 'down', 'i', 'm']
+    keymap = dict((key, key) for key in keys)
+    results = {}
+    for mode in ('dispatcher', 'spinning'):
+        source = QueueKeySource()
+        rng = random.Random(seed)
+
+        def feed():
+            for _ in range(presses):
+                sleep(rng.uniform(0.5, 1.5) * spacing)
+                key = rng.choice(keys)
+                source.press(key)
+                source.release(key)
+        feeder = threading.Thread(target=feed)
+        dispatcher = InputDispatcher(source, keymap)
+        latencies = []
+        wall, cpu = monotonic(), process_time()
+        feeder.start()
+        for _ in range(presses):
+            if mode == 'dispatcher':
+                dispatcher.wait()
+                latencies.append(dispatcher.latencies[-1])
+            else:
+                _, when = _spinningWait(source, keymap)
+                latencies.append(monotonic() - when)
+        feeder.join()
+        wall, cpu = monotonic() - wall, process_time() - cpu
+        latencies.sort()
+        results[mode] = dict(
+            cpu=cpu / wall, median=latencies[len(latencies) // 2],
+            worst=latencies[-1])
+        print('{:<11} CPU {:6.1%}  latency median {:.3f} ms, max {:.3f} ms'
+              .format(mode, cpu / wall, latencies[len(latencies) // 2] * 1e3,
+                      latencies[-1] * 1e3))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Window creation and text display with a console fallback.
+
+psychopy.visual is only imported when a window is actually wanted, headless
+runs print their text to the console instead. Measured frame rates are
+cached per monitor profile so getActualFrameRate only runs once.
+"""
+from __future__ import division, print_function
+import json
+import os
+
+frameRateCache = os.path.join('data', 'framerates.json')
+bottomEdge = -0.95  # lowest text position of the status screen (norm units)
+lineSpacing = 1.2  # text line height relative to the letter height
+
+
+def _loadFrameRates():
+    try:
+        with open(frameRateCache) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def measureFrameRate(win, monitor):
+    """Return the frame rate for this monitor profile, measuring and caching
+    it if it hasn't been seen before"""
+    key = '{}:{}x{}'.format(monitor, *win.size)
+    rates = _loadFrameRates()
+    if key in rates:
+        return rates[key]
+    frameRate = win.getActualFrameRate()
+    if frameRate is not None:
+        rates[key] = frameRate
+        try:
+            with open(frameRateCache, 'w') as f:
+                json.dump(rates, f, indent=2)
+        except (IOError, OSError):
+            pass
+    return frameRate
+
+
+def openWindow(headless=False, size=(1280, 1024), monitor='testMonitor'):
+    """Open the experiment window, returns the window and its frame rate,
+    (None, None) when headless"""
+    if headless:
+        return None, None
+    from psychopy import visual  # slow to import, only load when needed
+    win = visual.Window(size=size, fullscr=True, allowGUI=False, useFBO=True,
+                        monitor=monitor, units='norm')
+    return win, measureFrameRate(win, monitor)
+
+
+def showText(win, text, name='Text', **style):
+    """Draw text to the window and flip, or print it when headless"""
+    if win is None:
+        print(text)
+        return
+    from psychopy import visual
+    stim = visual.TextStim(win=win, name=name, text=text, **style)
+    stim.wrapWidth += 0.7
+    stim.draw()
+    win.flip()
+
+
+class StatusDisplay(object):
+    '''Status screen built from persistent text stimuli, one per field.
+
+    Only fields whose value changed get new text (the slow part of text
+    rendering) and the window is only redrawn when something changed.
+    skipped counts the updates that needed no redraw at all'''
+    def __init__(self, win, title, fields, footer=u'', **style):
+        super(StatusDisplay, self).__init__()
+        self.win = win
+        self.fields = list(fields)
+        self.values = {}
+        self.redraws = 0
+        self.skipped = 0
+        if win is None:
+            print(title)
+            return
+        from psychopy import visual
+        self.title = visual.TextStim(win=win, name='StatusTitle', text=title,
+                                     pos=(0, 0.7), **style)
+        self.stims = {}
+        for row, field in enumerate(self.fields):
+            self.stims[field] = visual.TextStim(
+                win=win, name='Status' + field, text=u'',
+                pos=(0, 0.5 - 0.15 * row), **style)
+        # The footer fills the space between the last field and the bottom
+        # edge, with smaller text if its lines don't fit at full height
+        height = style.get('height', 0.1)
+        footer = footer.rstrip()
+        lines = max(len(footer.splitlines()), 1)
+        top = 0.5 - 0.15 * (len(self.fields) - 1) - height
+        footerStyle = dict(style, height=min(
+            height, (top - bottomEdge) / (lines * lineSpacing)))
+        self.footer = visual.TextStim(win=win, name='StatusFooter',
+                                      text=footer,
+                                      pos=(0, (top + bottomEdge) / 2),
+                                      **footerStyle)
+        self.footer.wrapWidth += 0.7
+
+    def update(self, **values):
+        """Set field values, redrawing only if any of them changed"""
+        changed = [field for field in self.fields
+                   if field in values and
+                   (field not in self.values or
+                    values[field] != self.values[field])]
+        if not changed:
+            self.skipped += 1
+            return False
+        for field in changed:
+            self.values[field] = values[field]
+            text = u'{}:\t\t{}'.format(field, values[field])
+            if self.win is None:
+                print(text)
+            else:
+                self.stims[field].text = text
+        if self.win is not None:
+            self.title.draw()
+            for field in self.fields:
+                self.stims[field].draw()
+            self.footer.draw()
+            self.win.flip()
+        self.redraws += 1
+        return True
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Per-phase timing instrumentation of stimulus presentations.
+
+Every phase of a trial (planned start, getting the psychopy sound from a
+generated waveform or the volume cache, the play call, port raise and
+clear, playback completion) is timestamped into preallocated arrays used as
+a ring buffer, so recording is a locked counter increment and three array
+stores. Intervals between phases and their percentiles are only computed at
+the end. NullRecorder is a drop in that records nothing.
+"""
+from __future__ import division
+import threading
+import numpy as np
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+
+PHASES = ('planned', 'prepare', 'generate', 'cacheHit', 'playCall',
+          'playReturn', 'portRaise', 'portClear', 'complete')
+# (name, from phase, to phase) of the reported intervals
+INTERVALS = (('generate', 'prepare', 'generate'),
+             ('cacheHit', 'prepare', 'cacheHit'),
+             ('playDelay', 'planned', 'playCall'),
+             ('playCall', 'playCall', 'playReturn'),
+             ('portDelay', 'planned', 'portRaise'),
+             ('portPulse', 'portRaise', 'portClear'),
+             ('completion', 'playCall', 'complete'))
+PERCENTILES = (5, 50, 95, 99)
+
+
+class NullRecorder(object):
+    '''Recorder that records nothing'''
+    def mark(self, phase, index, when=None):
+        pass
+
+
+class PhaseRecorder(object):
+    '''Ring buffer of (trial index, phase, time) marks'''
+    def __init__(self, capacity=4096, clock=monotonic):
+        super(PhaseRecorder, self).__init__()
+        self.clock = clock
+        self.capacity = capacity
+        self.index = np.full(capacity, -1, dtype=np.int64)
+        self.phase = np.zeros(capacity, dtype=np.int8)
+        self.time = np.zeros(capacity)
+        self._codes = dict((name, code) for code, name in enumerate(PHASES))
+        self._lock = threading.Lock()
+        self.marks = 0
+
+    def mark(self, phase, index, when=None):
+        """Record phase of trial index at when (now if None), called from
+        the main and the scheduler threads"""
+        if index is None:
+            return
+        with self._lock:
+            slot = self.marks % self.capacity
+            self.marks += 1
+        self.time[slot] = self.clock() if when is None else when
+        self.phase[slot] = self._codes[phase]
+        self.index[slot] = index
+
+    @property
+    def dropped(self):
+        """Marks overwritten after the buffer wrapped"""
+        return max(0, self.marks - self.capacity)
+
+    def table(self):
+        """Trial indices and a trials x phases array of times (NaN where a
+        phase wasn't recorded), the latest mark wins for repeated phases"""
+        order = np.arange(self.marks - min(self.marks, self.capacity),
+                          self.marks) % self.capacity
+        index, phase = self.index[order], self.phase[order]
+        trials, rows = np.unique(index, return_inverse=True)
+        times = np.full((len(trials), len(PHASES)), np.nan)
+        times[rows, phase] = self.time[order]
+        return trials, times
+
+    def intervals(self):
+        """Trial indices and a dict of interval name -> seconds per trial"""
+        trials, times = self.table()
+        column = dict((name, code) for code, name in enumerate(PHASES))
+        return trials, dict((name, times[:, column[end]] -
+                             times[:, column[start]])
+                            for name, start, end in INTERVALS)
+
+    def summary(self):
+        """Count and percentiles in ms of every interval"""
+        _, intervals = self.intervals()
+        stats = {}
+        for name, _, _ in INTERVALS:
+            values = intervals[name][~np.isnan(intervals[name])] * 1e3
+            stats[name] = dict(N=len(values))
+            if len(values):
+                for p, value in zip(PERCENTILES,
+                                    np.percentile(values, PERCENTILES)):
+                    stats[name]['P{}_ms'.format(p)] = value
+                stats[name]['Max_ms'] = values.max()
+        return stats
+
+    def addToHandler(self, handler):
+        """Add one row per trial with its intervals in ms, then one summary
+        row per interval, to a psychopy ExperimentHandler"""
+        trials, intervals = self.intervals()
+        for row, trial in enumerate(trials):
+            handler.addData('Trial', int(trial))
+            for name, _, _ in INTERVALS:
+                value = intervals[name][row]
+                if not np.isnan(value):
+                    handler.addData(name + '_ms', value * 1e3)
+            handler.nextEntry()
+        for name, stats in sorted(self.summary().items()):
+            handler.addData('Interval', name)
+            for key, value in sorted(stats.items()):
+                handler.addData(key, value)
+            handler.nextEntry()
+        if self.dropped:
+            handler.addData('DroppedMarks', self.dropped)
+            handler.nextEntry()
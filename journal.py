@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe append-only journal of calibration marks.
+
+Every mark is written as one json line and fsync'd straight away, so no
+marked volume is lost if the session dies. The first line of a journal
+identifies the stimulus list it belongs to, which is how a session is
+matched up again for resuming.
+"""
+from __future__ import division
+import glob
+import hashlib
+import json
+import os
+import time
+
+
+def specDigest(sounds):
+    """Identify a stimulus list by the sounds (and targets) it contains"""
+    text = u'\n'.join(u'{}|{}'.format(snd, snd.target) for snd in sounds)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Journal(object):
+    '''Line-buffered, fsync'd journal with one json record per line'''
+    def __init__(self, filename, spec):
+        super(Journal, self).__init__()
+        self.filename = filename
+        fresh = not os.path.exists(filename)
+        self._file = open(filename, 'a', 1)
+        if fresh:
+            self.write('session', spec=spec)
+        elif not self._endsWithNewline():
+            self._file.write('\n')  # start clear of a torn final record
+
+    def _endsWithNewline(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if not f.tell():
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def write(self, kind, **fields):
+        fields['type'] = kind
+        fields['time'] = time.time()
+        self._file.write(json.dumps(fields) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def readJournal(filename):
+    """Yield the records of a journal, skipping records torn by a crash"""
+    with open(filename) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def findJournal(directory, spec):
+    """Return the most recent journal in directory for spec, or None"""
+    journals = glob.glob(os.path.join(directory, '*.journal'))
+    for filename in sorted(journals, key=os.path.getmtime, reverse=True):
+        for record in readJournal(filename):
+            if record.get('type') == 'session' and record['spec'] == spec:
+                return filename
+            break
+    return None
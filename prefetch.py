@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Background preparation of the stimuli around the current one.
+
+While calibrating, the neighbours of the current stimulus (the ones Left
+and Right move to) are generated or decoded and mixed to the current
+volume and channel gains on a worker thread, nearest first, so navigating
+only has to wrap a ready buffer in a psychopy sound. Prepared buffers are
+kept within a byte budget, buffers for other stimuli or volumes are dropped
+first.
+"""
+from __future__ import division
+import threading
+from collections import OrderedDict
+from stimuli import channelLevels, mixChannels
+
+
+class Prefetcher(object):
+    '''Prepares gained buffers for the stimuli within radius of a focus'''
+    def __init__(self, sounds, radius=2, maxBytes=64 * 2 ** 20):
+        super(Prefetcher, self).__init__()
+        self.sounds = sounds
+        self.radius = radius
+        self.maxBytes = maxBytes
+        self.buffers = OrderedDict()  # (index, levels) -> gained waveform
+        self.nbytes = 0
+        self.prepared = 0
+        self._focus = None
+        self._pending = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._worker,
+                                        name='Prefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def neighbours(self, index):
+        """Indices around index nearest first, wrapping like navigation"""
+        count = len(self.sounds)
+        found = []
+        for distance in range(1, self.radius + 1):
+            for step in (distance, -distance):
+                other = (index + step) % count
+                if other != index and other not in found:
+                    found.append(other)
+        return found
+
+    def focus(self, index, volume, channels=(1.0, 1.0)):
+        """Prepare the neighbours of index at volume and channel gains,
+        replacing any earlier focus that is still being worked on"""
+        focus = index, channelLevels(volume, channels)
+        with self._cond:
+            if focus != self._focus:
+                self._pending = focus
+                self._cond.notify()
+
+    def take(self, index, volume, channels=(1.0, 1.0)):
+        """Gained buffer for index at volume and channel gains if prepared,
+        else None"""
+        with self._cond:
+            gained = self.buffers.pop((index, channelLevels(volume, channels)),
+                                      None)
+            if gained is not None:
+                self.nbytes -= gained.nbytes
+            return gained
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and self._pending is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                self._focus = self._pending
+                self._pending = None
+            index, level = self._focus
+            for other in self.neighbours(index):
+                with self._cond:
+                    if self._pending is not None or not self._running:
+                        break  # moved on, start again from the new focus
+                self._prepare(other, level)
+
+    def _prepare(self, index, level):
+        key = index, level
+        with self._cond:
+            if key in self.buffers:
+                self.buffers[key] = self.buffers.pop(key)  # most recent
+                return
+        gained = mixChannels(self.sounds[index].load(), level)
+        with self._cond:
+            if gained.nbytes > self.maxBytes:
+                return
+            self.buffers[key] = gained
+            self.nbytes += gained.nbytes
+            self.prepared += 1
+            self._evict()
+
+    def _evict(self):
+        """Drop buffers until within budget, first the oldest of those
+        outside the current neighbourhood or at another volume, then the
+        farthest neighbours. The focus itself is kept until taken"""
+        index, level = self._focus
+        rank = dict(((other, level), order) for order, other in
+                    enumerate([index] + self.neighbours(index)))
+        while self.nbytes > self.maxBytes:
+            unwanted = [key for key in self.buffers if key not in rank]
+            victim = unwanted[0] if unwanted else max(self.buffers,
+                                                      key=rank.get)
+            self.nbytes -= self.buffers.pop(victim).nbytes
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
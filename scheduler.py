@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Event driven trial scheduling on a dedicated thread.
+
+Playback starts, port codes and their clearing are all run from a timer
+queue instead of busy-waits and blocking sleeps, and every event can be
+logged with a monotonic timestamp to a chunked triallog.EventLog (or any
+list). An action raising an error doesn't stop the worker: the error is
+logged, the outstanding trials are marked done and it is raised again on
+the thread waiting for them. MockPort and NullAudio let the scheduler run
+without a parallel port or sound card. An optional recorder (see
+instrument) timestamps the phases of indexed trials.
+"""
+from __future__ import division
+import heapq
+import itertools
+import threading
+from time import sleep
+from instrument import NullRecorder
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+
+
+class MockPort(object):
+    '''Stand in for psychopy.parallel.ParallelPort recording every write'''
+    def __init__(self, clock=monotonic):
+        super(MockPort, self).__init__()
+        self.clock = clock
+        self.writes = []
+
+    def setData(self, value):
+        self.writes.append((self.clock(), value))
+
+
+class NullAudio(object):
+    '''Audio backend that plays nothing, the stimulus is its own duration
+    in seconds or anything with a getDuration method'''
+    def play(self, stimulus):
+        if hasattr(stimulus, 'getDuration'):
+            return stimulus.getDuration()
+        return float(stimulus)
+
+
+class PsychopyAudio(object):
+    '''Audio backend playing psychopy sound objects'''
+    def play(self, stimulus):
+        stimulus.play()
+        return stimulus.getDuration()
+
+
+class Trial(object):
+    '''Timing of one scheduled presentation'''
+    def __init__(self, stimulus, code, index=None):
+        super(Trial, self).__init__()
+        self.stimulus = stimulus
+        self.code = code
+        self.index = index
+        self.played = None
+        self.completed = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block (without spinning) until playback has completed, raises the
+        error of a failed scheduler action"""
+        done = self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return done
+
+
+class TrialScheduler(object):
+    '''Runs timed actions from a priority queue on a worker thread'''
+    def __init__(self, port, audio, clock=monotonic, precision=0.0005,
+                 recorder=None, events=None):
+        """precision is how long before an event the worker stops sleeping
+        and yields until it is due, trading a little CPU for alignment.
+        recorder should use the same clock. events gets every (time, event,
+        value) appended from the worker thread, nothing is logged if None"""
+        super(TrialScheduler, self).__init__()
+        self.port = port
+        self.audio = audio
+        self.clock = clock
+        self.precision = precision
+        self.recorder = recorder or NullRecorder()
+        self.events = events
+        self.error = None
+        self._trials = set()  # played but not completed yet
+        self._queue = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._worker,
+                                        name='TrialScheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, event, value=None, when=None):
+        """Log an event with a timestamp (now unless given)"""
+        if self.events is not None:
+            self.events.append((self.clock() if when is None else when,
+                                event, value))
+
+    def at(self, when, action, *args):
+        """Run action(*args) on the worker thread at clock time when"""
+        with self._cond:
+            heapq.heappush(self._queue, (when, next(self._order), action,
+                                         args))
+            self._cond.notify()
+
+    def after(self, delay, action, *args):
+        self.at(self.clock() + delay, action, *args)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                when, _, action, args = self._queue[0]
+                delay = when - self.clock()
+                if delay > self.precision:
+                    # Sleep, woken early if something sooner is scheduled
+                    self._cond.wait(delay - self.precision)
+                    continue
+                heapq.heappop(self._queue)
+            while self.clock() < when:
+                sleep(0)  # yield for the final fraction
+            try:
+                action(*args)
+            except Exception as error:
+                self._fail(error)
+
+    def _fail(self, error):
+        """Log an action's error and fail every outstanding trial with it"""
+        self.record('error')
+        with self._cond:
+            if self.error is None:
+                self.error = error
+            trials, self._trials = self._trials, set()
+        for trial in trials:
+            trial.error = error
+            trial.done.set()
+
+    def check(self):
+        """Raise the first error of a scheduler action, if any"""
+        if self.error is not None:
+            raise self.error
+
+    def _setPort(self, value, index=None):
+        self.port.setData(value)
+        self.recorder.mark('portRaise' if value else 'portClear', index)
+        self.record('port', value)
+
+    def trigger(self, code=1, when=None, duration=0.005, index=None):
+        """Raise a port code at when (now if None) and clear it after
+        duration, without blocking the caller. index is the trial the
+        code belongs to for the recorder"""
+        self.check()
+        when = self.clock() if when is None else when
+        self.at(when, self._setPort, code, index)
+        self.at(when + duration, self._setPort, 0, index)
+
+    def _play(self, trial):
+        trial.played = self.clock()
+        self.recorder.mark('playCall', trial.index, trial.played)
+        duration = self.audio.play(trial.stimulus)
+        self.recorder.mark('playReturn', trial.index)
+        self.record('play', trial.code, trial.played)
+        self.at(trial.played + duration, self._complete, trial)
+
+    def _complete(self, trial):
+        trial.completed = self.clock()
+        self.recorder.mark('complete', trial.index, trial.completed)
+        self.record('complete', trial.code, trial.completed)
+        with self._cond:
+            self._trials.discard(trial)
+        trial.done.set()
+
+    def playTrial(self, stimulus, when=None, code=1, duration=0.005,
+                  index=None):
+        """Schedule playback and its port code for when (now if None),
+        returns a Trial that is marked done from the completion callback.
+        Phases are only recorded for trials given an index"""
+        self.check()
+        when = self.clock() if when is None else when
+        trial = Trial(stimulus, code, index)
+        with self._cond:
+            self._trials.add(trial)
+        self.recorder.mark('planned', index, when)
+        self.at(when, self._play, trial)
+        if code is not None:
+            self.trigger(code, when, duration, index)
+        return trial
+
+    def close(self):
+        """Stop the worker, pending events are discarded"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled playback sequences.
+
+Every repeat of every sound, and the silent gaps between them, are joined
+into one contiguous buffer that can be streamed with a single play call.
+An onset table records the sample at which each presentation starts.
+"""
+from __future__ import division
+import numpy as np
+from stimuli import channelLevels, mixChannels
+
+
+class CompiledSequence(object):
+    '''A contiguous buffer of all presentations plus their onset table'''
+    def __init__(self, sounds, rate, gap=0.05):
+        super(CompiledSequence, self).__init__()
+        self.rate = rate
+        self.gap = gap
+        gapLength = int(round(gap * rate))
+        channels = 1
+        levels = []
+        waveforms = []  # only held while compiling
+        for snd in sounds:
+            waveforms.append(snd.load())
+            if snd.rate != rate:
+                raise ValueError('{} has sample rate {}, expected {}'.format(
+                    snd, snd.rate, rate))
+            levels.append(channelLevels(snd.volume, snd.channels))
+            if np.ndim(waveforms[-1]) == 2:
+                channels = max(channels, waveforms[-1].shape[1])
+            if not np.isscalar(levels[-1]):
+                channels = max(channels, len(levels[-1]))
+        lengths = np.array([len(waveform) for waveform in waveforms],
+                           dtype=np.int64)
+        repeats = np.array([snd.repeats for snd in sounds], dtype=np.int64)
+        periods = lengths + gapLength
+        shape = (int(np.dot(periods, repeats)),)
+        if channels > 1:
+            shape += (channels,)
+        self.buffer = np.zeros(shape, dtype=np.float32)
+        # Onset table, one row per presentation
+        self.stimulus = np.repeat(np.arange(len(sounds)), repeats)
+        firsts = np.cumsum(repeats) - repeats
+        self.repeat = np.arange(len(self.stimulus)) - firsts[self.stimulus]
+        steps = periods[self.stimulus]
+        self.onsets = np.zeros(len(steps), dtype=np.int64)
+        np.cumsum(steps[:-1], out=self.onsets[1:])
+        self.lengths = lengths[self.stimulus]
+        start = 0
+        for waveform, level, length, period, count in zip(
+                waveforms, levels, lengths, periods, repeats):
+            block = self.buffer[start:start + period * count]
+            block = block.reshape((count, period) + shape[1:])
+            waveform = mixChannels(np.asarray(waveform, dtype=np.float32),
+                                   level)
+            if waveform.ndim == 1 and channels > 1:
+                waveform = waveform[:, None]
+            block[:, :length] = waveform
+            start += period * count
+
+    @property
+    def onsetTimes(self):
+        """Onset of every presentation in seconds from the buffer start"""
+        return self.onsets / self.rate
+
+    @property
+    def duration(self):
+        return len(self.buffer) / self.rate
+
+    def __len__(self):
+        return len(self.onsets)
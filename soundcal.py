@@ -10,110 +10,57 @@ from __future__ import division, print_function
 from psychopy import prefs
 prefs.general['audioLib'] = ['sounddevice', 'pyo', 'pygame']  # noqa E402
 prefs.general['audiodevice'] = u'SB Audigy 2 ZS ASIO [B000]'  # noqa E402
-from psychopy import visual, core, data, event, logging, gui, sound
-import csv
+from psychopy import core, data, logging, sound
 import os  # handy system and path functions
 import sys
-import pandas as pd
-from numpy import linspace
-import ast
-
-
-class SoundSpec(object):
-    def __init__(self):
-        self._sound = None
-        self.volume = 1.0
-        self._genVol = None
-
-    @property
-    def sound(self):
-        """return a sound if it exists, otherwise generate and return it"""
-        if self._sound and self.volume == self._genVol:
-            return self._sound
-        self._generate()
-        self._genVol = self.volume
-        return self._sound
-
-
-class SoundFromSpec(SoundSpec):
-    '''Holds a sound specification and returns a psychopy sound object when
-    queried'''
-    def __init__(self, specification=None):
-        """One and only one of filename or specification must be not None"""
-        super(SoundFromSpec, self).__init__()
-        self.freq = specification['Frequency']
-        self.dur = float(specification['Length'])
-        self.target = specification['Target']
-
-    def _generate(self):
-        self._sound = sound.Sound(value=self.freq, secs=self.dur,
-                                  volume=self.volume)
-
-    def __eq__(self, other):
-        if not isinstance(other, SoundFromSpec):
-            return NotImplemented
-        return (self.freq == other.freq and
-                self.dur == other.dur and
-                self.target == other.target)
-
-    def __hash__(self):
-        return hash((self.freq, self.dur, self.target))
-
-    def __str__(self):
-        return 'Freq:({0.freq}), Duration:({0.dur})'.format(self)
-
-
-class SoundFromFile(SoundSpec):
-    '''Holds a sound file and generates psychopy sound object as needed'''
-    def __init__(self, filename=None, target=None):
-        super(SoundFromFile, self).__init__()
-        self.filename = filename
-        self.target = target
-
-    def _generate(self):
-        self._sound = sound.Sound(value=self.filename, volume=self.volume)
-
-    def __eq__(self, other):
-        if not isinstance(other, SoundFromFile):
-            return NotImplemented
-        return (self.filename == other.filename and
-                self.target == other.target)
-
-    def __hash__(self):
-        return hash((self.filename, self.target))
-
-    def __str__(self):
-        return self.filename
-
-
-def loadSounds(soundfile):
-    """Read and parse the sounds.csv file"""
-    with open(soundfile) as soundfile:
-        soundreader = csv.DictReader(soundfile)
-        for row in soundreader:
-            length = row['Length']
-            if ';' in length:
-                row['Length'] = ast.literal_eval(length.replace(';', ','))
-            else:
-                row['Length'] = ast.literal_eval(length)
-            row['Frequency'] = ast.literal_eval(row['Frequency'])
-            yield row
+import numpy as np
+from stimuli import SoundFromFile, StimulusTable
+from specfile import loadSpec
+from wavecache import WaveformCache
+from stimqa import checkStimuli, problems, writeReport
+from journal import Journal, findJournal, readJournal, specDigest
+from display import openWindow, showText, StatusDisplay
+from dispatcher import InputDispatcher, PygletKeySource, ConsoleKeySource
+from autocal import AutoCalibrator, makeMeter
+from calmodel import CalibrationModel, markedPoints
+from caltable import writeTable
+from prefetch import Prefetcher
+
+# Channel gains used while calibrating each ear
+EARS = {'Both': (1.0, 1.0), 'Left': (1.0, 0.0), 'Right': (0.0, 1.0)}
 
 
 class Calibration(object):
     """Holds all experiment details such as implementation, run data (date etc)
     and creates resources like file descriptors and display adapters"""
-    def __init__(self, name='Calibration'):
-        """Setup the experiment, create windows and gather subject details"""
+    def __init__(self, name='Calibration', resume=False, headless=False,
+                 filelist=None, targets=None, rate=48000, buffer=256,
+                 device=None, outdir=None, perEar=False):
+        """Setup the experiment, create windows and gather subject details,
+        resume continues the latest journalled session for the same sounds.
+        headless skips the window and uses the console for text and keys.
+        targets maps wav files to dB targets so nothing is asked for, outdir
+        replaces the data directory (see batch.py). perEar calibrates the
+        left and right channels separately"""
         super(Calibration, self).__init__()
         self.date = data.getDateStr()
         self.name = name
-        file_filter = 'Sound specifications (*.csv);;Sound files (*.wav)'
-        self._inputhandling(gui.fileOpenDlg(allowed=file_filter))
+        self.resume = resume
+        self.headless = headless
+        self.rate = rate
+        self.buffer = buffer
+        self.device = device
+        self.outdir = outdir and os.path.abspath(outdir)
+        self.ears = ['Left', 'Right'] if perEar else ['Both']
+        if filelist is None:
+            from psychopy import gui
+            file_filter = 'Sound specifications (*.csv);;Sound files (*.wav)'
+            filelist = gui.fileOpenDlg(allowed=file_filter)
+        self._inputhandling(filelist, targets)
         self._filehandling()
         self._hwsetup()
 
-    def _inputhandling(self, filelist):
+    def _inputhandling(self, filelist, targets=None):
         """Handles the result of the file selection dialog"""
         if not filelist:
             self.cleanQuit()
@@ -121,10 +68,17 @@ class Calibration(object):
         self.readSounds = {}
         for f in filelist:
             if f[-3:] == 'csv':
-                self.genSounds.extend(list(loadSounds(f)))
+                self.genSounds.append(loadSpec(f))
             else:
-                self.readSounds[f] = ''
-        if self.readSounds:
+                self.readSounds[f] = (targets or {}).get(f, '')
+        if targets is not None:
+            return  # given up front, nothing to ask
+        if self.readSounds and self.headless:
+            for f in self.readSounds:
+                print('Enter dB Target for ' + f)
+                self.readSounds[f] = sys.stdin.readline().strip()
+        elif self.readSounds:
+            from psychopy import gui
             gui.DlgFromDict(self.readSounds,
                             title='Enter dB Target per file - CSV for > 1')
 
@@ -136,7 +90,8 @@ class Calibration(object):
         os.chdir(_thisDir)
         # Create base output filename
         filestruct = '{0.name}_{0.date}'.format(self)
-        self.filename = os.path.join(_thisDir, 'data/'+filestruct)
+        self.filename = os.path.join(self.outdir or _thisDir + '/data',
+                                     filestruct)
         # save a log file for detail verbose info
         self.logFile = logging.LogFile(self.filename + '.log',
                                        level=logging.EXP)
@@ -144,17 +99,17 @@ class Calibration(object):
 
     def _hwsetup(self):
         """Set up hardware like displays, sounds, etc"""
-        self.win = visual.Window(size=(1280, 1024), fullscr=True,
-                                 allowGUI=False, useFBO=True,
-                                 monitor='testMonitor', units='norm')
-        # store frame rate of monitor if we can measure it successfully
-        self.frameRate = self.win.getActualFrameRate()
+        # store frame rate of monitor if we can measure it successfully,
+        # measured once per monitor profile and cached
+        self.win, self.frameRate = openWindow(headless=self.headless)
         if self.frameRate is not None:
             self.frameDur = 1.0/round(self.frameRate)
         else:
             self.frameDur = 1.0/60.0  # couldn't get a reliable measure/guess
         # Set up the sound card
-        sound.init(rate=48000, stereo=True, buffer=256)
+        if self.device is not None:
+            prefs.general['audiodevice'] = self.device
+        sound.init(rate=self.rate, stereo=True, buffer=self.buffer)
         self.volume = 0.4
 
     def buildStimuli(self):
@@ -162,18 +117,17 @@ class Calibration(object):
         # Initialize components for Routine "TDTInstructions"
         self.defaulttext = dict(font='Arial', height=0.1, alignHoriz='center')
 
-        self.sounds = []
-        for filename, target in self.readSounds.items():
-            self.sounds.append(SoundFromFile(filename=filename, target=target))
-
-        for spec in self.genSounds:
-            try:
-                self.sounds.append(SoundFromSpec(spec))
-            except TypeError:
-                for dur in linspace(*spec['Length']):
-                    newspec = spec.copy()
-                    newspec['Length'] = dur
-                    self.sounds.append(SoundFromSpec(newspec))
+        files = [SoundFromFile(filename=filename, target=target)
+                 for filename, target in self.readSounds.items()]
+        self.sounds = StimulusTable(self.genSounds, files, rate=self.rate)
+        # Load cached waveforms and synthesise the rest in one batch
+        self.sounds.render(WaveformCache())
+        # Check the generated stimuli before anything is presented, wav
+        # files are checked by batch.py prepare so they aren't read here
+        self.qa = checkStimuli(self.sounds, files=False)
+        writeReport(self.filename + '_qa.csv', self.qa)
+        for name, issue in problems(self.qa):
+            logging.warning('Stimulus {} failed QA: {}'.format(name, issue))
 
     def runInstructions(self):
         """Present the instructions"""
@@ -187,16 +141,17 @@ class Calibration(object):
             ↑\t\t\t- change volume up
             i\t\t\t- change volume increment (0.1, 0.01, 0.001)
             m\t\t- mark volume as correct
+            n\t\t\t- go to most informative unmarked sound
+            e\t\t\t- switch ear (per ear calibration)
             p\t\t\t- plot results
             Escape\t- quits
 
         Press any key to continue
         '''
-        instruction = visual.TextStim(win=self.win, name='InstrText',
-                                      text=itext, **self.defaulttext)
-        instruction.wrapWidth += 0.7
-        instruction.draw()
-        self.win.flip()
+        showText(self.win, itext, name='InstrText', **self.defaulttext)
+        if self.win is None:
+            return  # keys are typed per action on the console
+        from psychopy import event
         while True:
             theseKeys = event.getKeys()
             if theseKeys:
@@ -226,93 +181,295 @@ class Calibration(object):
         toggle = {0.1: 0.01, 0.01: 0.001, 0.001: 0.1}
         self.inc = toggle[self.inc]
 
+    def switchear(self):
+        self.ear = self.ears[(self.ears.index(self.ear) + 1) %
+                             len(self.ears)]
+
+    @property
+    def marked(self):
+        """Marked volumes of every sound for the ear being calibrated"""
+        return self.results[self.ear]
+
     def mark(self):
-        self.marked[self.current].append(self.vol)
+        self.marked[self.idx].append(self.vol)
+        self.journal.write('mark', idx=self.idx, sound=str(self.current),
+                           vol=self.vol, ear=self.ear)
+
+    def _model(self, ear=None):
+        """Calibration model over the generated sounds, fitted to the marks
+        for an ear (the current one if None) if there are enough of them,
+        with the sound index, frequency and duration of each grid point"""
+        grid = self.sounds.generated
+        freqs = self.sounds.data['Frequency'][grid]
+        durs = self.sounds.data['Duration'][grid]
+        if not len(grid):
+            return None, grid, freqs, durs
+        model = CalibrationModel(freqs, durs)
+        points = markedPoints(self.sounds, self.results[ear or self.ear])
+        if len(points[0]) >= model.minimumPoints:
+            model.fit(*points)
+        return model, grid, freqs, durs
+
+    def _suggest(self, count=1):
+        """Indices of the unmarked sounds that would add the most
+        information to the calibration model"""
+        model, grid, freqs, durs = self._model()
+        if model is None:
+            return []
+        measured = [bool(self.marked[idx]) for idx in grid]
+        return [int(grid[i]) for i in model.suggest(freqs, durs, measured,
+                                                    count)]
+
+    def informative(self):
+        """Go to the most informative unmarked sound"""
+        suggested = self._suggest()
+        if suggested:
+            self.idx = suggested[0]
 
     def check_keys(self, sound=None):
-        event.clearEvents()
-        repeatTimer = core.CountdownTimer(1.5)
-        keymap = {'left': self.previous,
-                  'right': self.next,
-                  'up': self.increase,
-                  'down': self.decrease,
-                  'i': self.toggleinc,
-                  'm': self.mark,
-                  'escape': self.cleanQuit}
+        """Play the sound and block until a key action is due, the
+        dispatcher replays the sound every 1.5 s while waiting"""
         sound.play()
-        while True:
-            theseKeys = event.getKeys(keyList=keymap.keys())
-            if len(theseKeys) > 0:  # at least one key was pressed
-                # grab just the first key pressed
-                key = theseKeys[0]
-                # return action
-                return keymap[key]
-            if repeatTimer.getTime() < 0:
-                sound.play()
-                repeatTimer.reset()
+        return self.dispatcher.wait(replay=sound.play)
 
     @property
     def current(self):
         """Return current sound"""
         return self.sounds[self.idx]
 
-    def runCalibration(self):
-        '''Run through all sounds and check calibration'''
+    def _openJournal(self):
+        """Start a journal of marks for this session, or when resuming replay
+        and continue the latest journal for the same sounds"""
+        spec = specDigest(self.sounds)
+        filename = None
+        if self.resume:
+            filename = findJournal(os.path.dirname(self.filename), spec)
+        if filename:
+            for record in readJournal(filename):
+                ear = record.get('ear', 'Both')
+                if record['type'] == 'mark' and ear in self.results:
+                    self.idx, self.vol = record['idx'], record['vol']
+                    self.results[ear][self.idx].append(self.vol)
+            logging.exp('Resumed calibration from ' + filename)
+        self.journal = Journal(filename or self.filename + '.journal', spec)
+
+    def _startSession(self, title):
+        """Reset navigation, results and the status display"""
         self.idx = 0
         self.vol = 0.4
         self.inc = 0.1
-        self.marked = {k: [] for k in self.sounds}
-        rtext = u'''
-        Calibration in progress
-
-            Sound:\t\t{}
-            Target:\t\t{}
-            Marked:\t\t{}
-            Volume:\t\t{}
-            
-        Keys:
+        self.ear = self.ears[0]
+        self.results = dict((ear, [[] for _ in range(len(self.sounds))])
+                            for ear in self.ears)
+        self.prefetcher = Prefetcher(self.sounds)
+        self._openJournal()
+        # Text stimuli are created once and only updated when values change
+        keytext = u'''Keys:
             <Esc> to quit
             <Up>/<Down> for volume
             <Left>/<Right> to choose sound
             <i> for volume increment
             <m> to associate volume with sound
+            <n> for the most informative unmarked sound
         '''
+        fields = ['Sound', 'Target', 'Marked', 'Volume']
+        if len(self.ears) > 1:
+            keytext = keytext.rstrip() + u'\n            <e> to switch ear'
+            fields.append('Ear')
+        self.status = StatusDisplay(self.win, title, fields, keytext,
+                                    **self.defaulttext)
+
+    def _showStatus(self):
+        self.status.update(Sound=str(self.current),
+                           Target=self.current.target,
+                           Marked=bool(self.marked[self.idx]),
+                           Volume=self.vol, Ear=self.ear)
+
+    def runCalibration(self):
+        '''Run through all sounds and check calibration'''
+        self._startSession(u'Calibration in progress')
+        keymap = {'left': self.previous,
+                  'right': self.next,
+                  'up': self.increase,
+                  'down': self.decrease,
+                  'i': self.toggleinc,
+                  'm': self.mark,
+                  'n': self.informative,
+                  'escape': self.cleanQuit}
+        if len(self.ears) > 1:
+            keymap['e'] = self.switchear
+        if self.win is None:
+            source = ConsoleKeySource(keys=keymap)
+        else:
+            source = PygletKeySource(self.win)
+        self.dispatcher = InputDispatcher(source, keymap, replayInterval=1.5,
+                                          repeatKeys=('up', 'down'))
         while True:
             # Display our current information
-            txt = rtext.format(self.current, self.current.target,
-                               bool(self.marked[self.current]), self.vol)
-            runText = visual.TextStim(win=self.win, name='RunText',
-                                      text=txt, **self.defaulttext)
-            runText.wrapWidth += 0.7
-            runText.draw()
-            self.win.flip()
+            self._showStatus()
+            # Neighbours are prepared in the background while this plays
+            channels = EARS[self.ear]
+            self.prefetcher.focus(self.idx, self.vol, channels)
             # Check keys, play sounds and then perform resulting actions
             self.current.volume = self.vol
-            action = self.check_keys(self.current.sound)
+            self.current.channels = channels
+            action = self.check_keys(self.current.getSound(
+                self.prefetcher.take(self.idx, self.vol, channels)))
             action()
 
+    def runAutoCalibration(self, meter, sparse=None):
+        '''Calibrate every sound against a meter backend without a person
+        in the loop, results are marked exactly as in manual calibration.
+        Sounds whose target couldn't be reached are journalled as unreached
+        and left unmarked, so resuming tries them again. With sparse only
+        that many of the most informative generated sounds are measured,
+        the model predicts the rest. Wav files are always measured as the
+        model can't predict them'''
+        self._startSession(u'Automatic calibration in progress')
+        calibrator = AutoCalibrator(meter)
+        if sparse:
+            model = self._model()[0]
+            if model is not None and sparse < model.minimumPoints:
+                logging.warning(
+                    'Sparse calibration of {} sounds is too few to fit the '
+                    'calibration model, measuring {}'.format(
+                        sparse, model.minimumPoints))
+                sparse = model.minimumPoints
+            order = self._suggest(sparse) + list(range(len(
+                self.sounds.files)))
+        else:
+            order = range(len(self.sounds))
+        for idx in order:
+            self.idx = idx
+            snd = self.current
+            if snd.target in (None, ''):
+                logging.warning('No target for {}, skipped'.format(snd))
+                continue
+            for ear in self.ears:
+                self.ear = ear
+                if self.marked[idx]:
+                    continue  # already marked in a resumed session
+                snd.channels = EARS[ear]
+                self._showStatus()
+                volume, level, presentations, converged = \
+                    calibrator.calibrate(snd, volume=self.vol)
+                if not converged:
+                    logging.warning(
+                        '{} ({}): target {} dB not reached, volume {:.4f} '
+                        'gave {:.2f} dB, not marked'.format(
+                            snd, ear, snd.target, volume, level))
+                    self.journal.write('unreached', idx=idx, sound=str(snd),
+                                       vol=volume, level=level, ear=ear)
+                    continue
+                self.vol = volume
+                logging.exp('{} ({}): volume {:.4f} gave {:.2f} dB in {} '
+                            'presentations'.format(snd, ear, self.vol, level,
+                                                   presentations))
+                self.mark()
+        self._showStatus()
+        meter.close()
+
+    def _suffix(self, ear):
+        return '' if ear == 'Both' else '_' + ear
+
+    def _writeModel(self, ear):
+        """Write predicted volumes for every generated sound if enough have
+        been marked for an ear to fit the calibration model"""
+        import pandas as pd
+        model, grid, freqs, durs = self._model(ear)
+        if model is None:
+            return
+        if model.coef is None:
+            logging.warning(
+                'Only {} sounds marked ({}), {} are needed to fit the '
+                'calibration model, no model written'.format(
+                    len(markedPoints(self.sounds, self.results[ear])[0]),
+                    ear, model.minimumPoints))
+            return
+        targets = self.sounds.data['Target'][grid]
+        predicted = pd.DataFrame({
+            'Frequency': freqs, 'Duration': durs, 'Target': targets,
+            'Volume': model.predict(freqs, durs, targets),
+            'StdErr_dB': model.uncertainty(freqs, durs),
+            'Marked': [bool(self.results[ear][idx]) for idx in grid]},
+            index=[str(self.sounds[idx]) for idx in grid],
+            columns=['Frequency', 'Duration', 'Target', 'Volume',
+                     'StdErr_dB', 'Marked'])
+        predicted.to_csv(self.filename + '_model' + self._suffix(ear) +
+                         '.csv')
+
+    def _writeTable(self, ear):
+        """Export volumes of generated sounds for an ear as a compact lookup
+        table (see caltable) for experiment scripts, the marked volume where
+        there is one and the model's prediction for the rest if it could be
+        fitted"""
+        points = markedPoints(self.sounds, self.results[ear])
+        model, grid, freqs, durs = self._model(ear)
+        if model is not None and model.coef is not None:
+            targets = self.sounds.data['Target'][grid]
+            fill = ~np.isnan(targets) & np.array(
+                [not self.results[ear][idx] for idx in grid], dtype=bool)
+            predicted = (freqs[fill], durs[fill], targets[fill],
+                         model.predict(freqs[fill], durs[fill],
+                                       targets[fill]))
+            points = [np.concatenate(pair) for pair in zip(points, predicted)]
+        freqs, durs, targets, volumes = points
+        if len(volumes):
+            writeTable(self.filename + self._suffix(ear) + '.cal', freqs,
+                       durs, targets, volumes)
+
     def cleanQuit(self):
         """Cleanly quit psychopy and run any internal cleanup"""
         # Finalising data writing etc
         # these shouldn't be strictly necessary (should auto-save)
-        results = pd.DataFrame.from_dict(self.marked, orient='index')
+        import pandas as pd
+        names = [str(snd) for snd in self.sounds]
+        if self.ears == ['Both']:
+            results = pd.DataFrame(self.marked, index=names)
+        else:
+            # Volume columns for each ear side by side
+            results = pd.concat([pd.DataFrame(self.results[ear], index=names)
+                                 .add_prefix(ear + '_') for ear in self.ears],
+                                axis=1)
         results.to_csv(self.filename+'.csv')
+        for ear in self.ears:
+            self._writeModel(ear)
+            self._writeTable(ear)
+        self.journal.close()
+        self.prefetcher.close()
+        logging.exp('Prefetched {} buffers'.format(self.prefetcher.prepared))
+        logging.exp('Status redraws: {0.redraws}, skipped: {0.skipped}'.format(
+            self.status))
         logging.flush()
         # make sure everything is closed down
-        self.win.close()
+        if self.win is not None:
+            self.win.close()
         core.quit()
 
-    def run(self, debug=False):
-        """Run the whole experiment"""
+    def run(self, debug=False, meter=None, sparse=None):
+        """Run the whole experiment, calibrating automatically if given an
+        SPL meter backend (only sparse sounds if given)"""
         # Setup
         self.buildStimuli()
 
-        self.runInstructions()
-        self.runCalibration()
+        if meter is not None:
+            self.runAutoCalibration(meter, sparse=sparse)
+        else:
+            self.runInstructions()
+            self.runCalibration()
 
         self.cleanQuit()
 
 
 if __name__ == '__main__':
-    exp = Calibration()
-    exp.run()
+    files = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    exp = Calibration(resume='--resume' in sys.argv,
+                      headless='--headless' in sys.argv,
+                      filelist=files or None,
+                      perEar='--per-ear' in sys.argv)
+    meters = [arg.split('=', 1)[1] for arg in sys.argv
+              if arg.startswith('--meter=')]
+    sparse = [int(arg.split('=', 1)[1]) for arg in sys.argv
+              if arg.startswith('--sparse=')]
+    exp.run(meter=makeMeter(meters[0]) if meters else None,
+            sparse=sparse[0] if sparse else None)
@@ -10,111 +10,54 @@ from __future__ import division, print_function
 from psychopy import prefs
 prefs.general['audioLib'] = ['sounddevice', 'pyo', 'pygame']  # noqa E402
 prefs.general['audiodevice'] = u'SB Audigy 2 ZS Audio [B000]'  # noqa E402
-from psychopy import visual, core, data, event, logging, gui, sound, parallel
-from psychopy.constants import PLAYING
-import csv
+from psychopy import core, data, logging, sound
 import os  # handy system and path functions
 import sys
-import pandas as pd
-from numpy import linspace
-import ast
+from stimuli import SoundFromFile, StimulusTable
+from specfile import loadSpec
+from wavecache import WaveformCache
+from stimqa import checkStimuli, problems, writeReport
+from sequence import CompiledSequence
+from scheduler import TrialScheduler, PsychopyAudio, MockPort
+from instrument import PhaseRecorder, NullRecorder
+from triallog import TrialLog, EventLog, convertTrialLog, convertEventLog
+from display import openWindow, showText
 
 volume = 0.2
 
 
-class SoundSpec(object):
-    def __init__(self):
-        self._sound = None
-        self.volume = volume
-
-    @property
-    def sound(self):
-        """return a sound if it exists, otherwise generate and return it"""
-        if self._sound:
-            return self._sound
-        self._generate()
-        return self._sound
-
-
-class SoundFromSpec(SoundSpec):
-    '''Holds a sound specification and returns a psychopy sound object when
-    queried'''
-    def __init__(self, specification=None):
-        """One and only one of filename or specification must be not None"""
-        super(SoundFromSpec, self).__init__()
-        self.freq = specification['Frequency']
-        self.dur = float(specification['Length'])
-        self.repeats = int(specification['Repeats'])
-
-    def _generate(self):
-        self._sound = sound.Sound(value=self.freq, secs=self.dur,
-                                  volume=volume)
-
-    def __eq__(self, other):
-        if not isinstance(other, SoundFromSpec):
-            return NotImplemented
-        return (self.freq == other.freq and
-                self.dur == other.dur and
-                self.repeats == other.repeats)
-
-    def __hash__(self):
-        return hash((self.freq, self.dur, self.repeats))
-
-    def __str__(self):
-        return 'Freq:({0.freq}), Duration:({0.dur})'.format(self)
-
-
-class SoundFromFile(SoundSpec):
-    '''Holds a sound file and generates psychopy sound object as needed'''
-    def __init__(self, filename=None, repeats=None):
-        super(SoundFromFile, self).__init__()
-        self.filename = filename
-        self.repeats = int(repeats)
-
-    def _generate(self):
-        self._sound = sound.Sound(value=self.filename, volume=volume)
-
-    def __eq__(self, other):
-        if not isinstance(other, SoundFromFile):
-            return NotImplemented
-        return (self.filename == other.filename and
-                self.repeats == other.repeats)
-
-    def __hash__(self):
-        return hash((self.filename, self.repeats))
-
-    def __str__(self):
-        return self.filename
-
-
-def loadSounds(soundfile):
-    """Read and parse the sounds.csv file"""
-    with open(soundfile) as soundfile:
-        soundreader = csv.DictReader(soundfile)
-        for row in soundreader:
-            length = row['Length']
-            if ';' in length:
-                row['Length'] = ast.literal_eval(length.replace(';', ','))
-            else:
-                row['Length'] = ast.literal_eval(length)
-            row['Frequency'] = ast.literal_eval(row['Frequency'])
-            yield row
-
-
 class SoundTest(object):
     """Holds all experiment details such as implementation, run data (date etc)
     and creates resources like file descriptors and display adapters"""
-    def __init__(self, name='Calibration'):
-        """Setup the experiment, create windows and gather subject details"""
+    def __init__(self, name='Calibration', headless=False, filelist=None,
+                 repeats=None, rate=48000, buffer=256, device=None,
+                 outdir=None, instrument=False, mockPort=False):
+        """Setup the experiment, create windows and gather subject details,
+        headless skips the window and prints text to the console, codes
+        still go to the parallel port. mockPort only logs the codes, for
+        tests without a port. repeats maps wav files to repeat counts so
+        nothing is asked for, outdir replaces the data directory (see
+        batch.py). instrument records the timing of every phase of each
+        trial (see instrument)"""
         super(SoundTest, self).__init__()
         self.date = data.getDateStr()
         self.name = name
-        file_filter = 'Sound specifications (*.csv);;Sound files (*.wav)'
-        self._inputhandling(gui.fileOpenDlg(allowed=file_filter))
+        self.headless = headless
+        self.rate = rate
+        self.buffer = buffer
+        self.device = device
+        self.outdir = outdir and os.path.abspath(outdir)
+        self.instrument = instrument
+        self.mockPort = mockPort
+        if filelist is None:
+            from psychopy import gui
+            file_filter = 'Sound specifications (*.csv);;Sound files (*.wav)'
+            filelist = gui.fileOpenDlg(allowed=file_filter)
+        self._inputhandling(filelist, repeats)
         self._filehandling()
         self._hwsetup()
 
-    def _inputhandling(self, filelist):
+    def _inputhandling(self, filelist, repeats=None):
         """Handles the result of the file selection dialog"""
         if not filelist:
             self.cleanQuit()
@@ -122,10 +65,17 @@ class SoundTest(object):
         self.readSounds = {}
         for f in filelist:
             if f[-3:] == 'csv':
-                self.genSounds.extend(list(loadSounds(f)))
+                self.genSounds.append(loadSpec(f))
             else:
-                self.readSounds[f] = ''
-        if self.readSounds:
+                self.readSounds[f] = (repeats or {}).get(f, '')
+        if repeats is not None:
+            return  # given up front, nothing to ask
+        if self.readSounds and self.headless:
+            for f in self.readSounds:
+                print('Enter number of repeats for ' + f)
+                self.readSounds[f] = sys.stdin.readline().strip()
+        elif self.readSounds:
+            from psychopy import gui
             gui.DlgFromDict(self.readSounds,
                             title='Enter number of repeats per file - CSV for > 1')
 
@@ -137,59 +87,75 @@ class SoundTest(object):
         os.chdir(_thisDir)
         # Create base output filename
         filestruct = '{0.name}_{0.date}'.format(self)
-        self.filename = os.path.join(_thisDir, 'data/'+filestruct)
+        self.filename = os.path.join(self.outdir or _thisDir + '/data',
+                                     filestruct)
         # save a log file for detail verbose info
         self.logFile = logging.LogFile(self.filename + '.log',
                                        level=logging.EXP)
         logging.console.setLevel(logging.WARNING)  # this outputs to the screen
-        # An ExperimentHandler isn't essential but helps with data saving
-        self.handler = data.ExperimentHandler(name=self.name,
-                                              dataFileName=self.filename)
+        # Trials are written to a TrialLog during the run and converted to
+        # csv at the end, the ExperimentHandler only collects phase timing
+        if self.instrument:
+            self.handler = data.ExperimentHandler(
+                name=self.name, dataFileName=self.filename + '_phases')
 
     def _hwsetup(self):
         """Set up hardware like displays, sounds, etc"""
-        self.win = visual.Window(size=(1280, 1024), fullscr=True,
-                                 allowGUI=False, useFBO=True,
-                                 monitor='testMonitor', units='norm')
-        # store frame rate of monitor if we can measure it successfully
-        self.frameRate = self.win.getActualFrameRate()
-        # Create a parallel port handler
-        self.port = parallel.ParallelPort(address=0x0378)
+        # store frame rate of monitor if we can measure it successfully,
+        # measured once per monitor profile and cached
+        self.win, self.frameRate = openWindow(headless=self.headless)
         self.clock = core.Clock()  # to track the time since experiment started
+        # Create a parallel port handler, a mock port only logs the codes
+        if self.mockPort:
+            self.port = MockPort(clock=self.clock.getTime)
+        else:
+            from psychopy import parallel
+            self.port = parallel.ParallelPort(address=0x0378)
+        if self.instrument:
+            self.recorder = PhaseRecorder(capacity=2 ** 16,
+                                          clock=self.clock.getTime)
+        else:
+            self.recorder = NullRecorder()
+        # Playback and port codes are timed from a scheduler thread, its
+        # events are logged a chunk at a time and converted to csv at the end
+        self.eventLog = EventLog(self.filename + '.events')
+        self.scheduler = TrialScheduler(self.port, PsychopyAudio(),
+                                        clock=self.clock.getTime,
+                                        recorder=self.recorder,
+                                        events=self.eventLog)
         if self.frameRate is not None:
             self.frameDur = 1.0/round(self.frameRate)
         else:
             self.frameDur = 1.0/60.0  # couldn't get a reliable measure/guess
         # Set up the sound card
-        sound.init(rate=48000, stereo=True, buffer=256)
+        if self.device is not None:
+            prefs.general['audiodevice'] = self.device
+        sound.init(rate=self.rate, stereo=True, buffer=self.buffer)
 
     def send_code(self, code=1, duration=0.005, stimulus=None):
         """Send a code and clear it after duration, use code from stimulus if
-        it exists"""
+        it exists. The code is cleared from a timer so this doesn't block"""
         if stimulus:
-            self.port.setData(stimulus['PortCode'])
-        else:
-            self.port.setData(code)
-        core.wait(duration)
-        self.port.setData(0)
+            code = stimulus['PortCode']
+        self.scheduler.trigger(code, duration=duration)
 
     def buildStimuli(self):
         """Build individual stimuli for use in the experiment"""
         # Initialize components for Routine "TDTInstructions"
         self.defaulttext = dict(font='Arial', height=0.05, alignHoriz='center')
 
-        self.sounds = []
-        for filename, repeats in self.readSounds.items():
-            self.sounds.append(SoundFromFile(filename=filename, repeats=repeats))
-
-        for spec in self.genSounds:
-            try:
-                self.sounds.append(SoundFromSpec(spec))
-            except TypeError:
-                for dur in linspace(*spec['Length']):
-                    newspec = spec.copy()
-                    newspec['Length'] = dur
-                    self.sounds.append(SoundFromSpec(newspec))
+        files = [SoundFromFile(filename=filename, repeats=repeats)
+                 for filename, repeats in self.readSounds.items()]
+        self.sounds = StimulusTable(self.genSounds, files, rate=self.rate)
+        self.sounds.setGain(volume)
+        # Load cached waveforms and synthesise the rest in one batch
+        self.sounds.render(WaveformCache())
+        # Check the generated stimuli before anything is presented, wav
+        # files are checked by batch.py prepare so they aren't read here
+        self.qa = checkStimuli(self.sounds, files=False)
+        writeReport(self.filename + '_qa.csv', self.qa)
+        for name, issue in problems(self.qa):
+            logging.warning('Stimulus {} failed QA: {}'.format(name, issue))
 
     def runInstructions(self):
         """Present the instructions"""
@@ -199,11 +165,10 @@ class SoundTest(object):
         PC's sound input to record pulses and outputted sound.
         Press any key to continue
         '''
-        instruction = visual.TextStim(win=self.win, name='InstrText',
-                                      text=itext, **self.defaulttext)
-        instruction.wrapWidth += 0.7
-        instruction.draw()
-        self.win.flip()
+        if self.win is None:
+            return  # nothing to wait for in a headless timing run
+        showText(self.win, itext, name='InstrText', **self.defaulttext)
+        from psychopy import event
         while True:
             theseKeys = event.getKeys()
             if theseKeys:
@@ -219,22 +184,45 @@ class SoundTest(object):
         rtext = u'''
         Timing test in progress
         '''
-        runText = visual.TextStim(win=self.win, name='RunText',
-                                  text=rtext, **self.defaulttext)
-        runText.wrapWidth += 0.7
-        runText.draw()
-        self.win.flip()
-        for snd in self.sounds:
+        showText(self.win, rtext, name='RunText', **self.defaulttext)
+        when = self.clock.getTime()
+        index = 0
+        for stimulusId, snd in enumerate(self.sounds):
             for rep in range(snd.repeats):
-                print(rep)
-                self.handler.addData('Snd', rep)
-                self.handler.addData('Timestamp', self.clock.getTime())
-                snd.sound.play()
-                self.send_code()
-                while (snd.sound.status == PLAYING):
-                    pass
-                core.wait(0.05)
-            print('Snd' + str(snd))
+                self.recorder.mark('prepare', index)
+                phase = 'cacheHit' if snd.cached else 'generate'
+                stimulus = snd.sound
+                self.recorder.mark(phase, index)
+                trial = self.scheduler.playTrial(stimulus, when=when,
+                                                 index=index)
+                # Sleep until the completion callback fires
+                trial.wait()
+                self.trialLog.add(stimulusId, rep, when, trial.played,
+                                  trial.completed, trial.code)
+                when = trial.completed + 0.05
+                index += 1
+            logging.exp('Played ' + str(snd))
+
+    def runCompiledSoundtest(self, gap=0.05):
+        '''Play every repeat from one pre-compiled buffer, triggers and
+        timestamps are scheduled from the sample-indexed onset table'''
+        rtext = u'''
+        Timing test in progress (compiled sequence)
+        '''
+        showText(self.win, rtext, name='RunText', **self.defaulttext)
+        seq = CompiledSequence(self.sounds, self.rate, gap=gap)
+        stream = sound.Sound(value=seq.buffer, sampleRate=self.rate,
+                             hamming=False)
+        # Schedule the stream and every trigger up front
+        start = self.clock.getTime() + 0.1
+        done = self.scheduler.playTrial(stream, when=start, code=None)
+        for trial, onset in enumerate(seq.onsetTimes):
+            self.recorder.mark('planned', trial, start + onset)
+            self.scheduler.trigger(1, when=start + onset, index=trial)
+        self.trialLog.extend(seq.stimulus, seq.repeat,
+                             start + seq.onsetTimes, code=1,
+                             sample=seq.onsets)
+        done.wait()
 
     def cleanQuit(self):
         """Cleanly quit psychopy and run any internal cleanup"""
@@ -242,20 +230,39 @@ class SoundTest(object):
         # these shouldn't be strictly necessary (should auto-save)
         logging.flush()
         # make sure everything is closed down
-        self.win.close()
+        self.scheduler.close()
+        if self.win is not None:
+            self.win.close()
         core.quit()
 
-    def run(self, debug=False):
+    def run(self, debug=False, compiled=False):
         """Run the whole experiment"""
         # Setup
         self.buildStimuli()
 
         self.runInstructions()
-        self.runSoundtest()
+        self.trialLog = TrialLog(self.filename + '.trials',
+                                 [str(snd) for snd in self.sounds])
+        if compiled:
+            self.runCompiledSoundtest()
+        else:
+            self.runSoundtest()
+        self.trialLog.close()
+        convertTrialLog(self.filename + '.trials', self.filename + '.csv')
+        # The worker appends to the event log, stop it before closing
+        self.scheduler.close()
+        self.eventLog.close()
+        convertEventLog(self.filename + '.events',
+                        self.filename + '_events.csv')
+        if self.instrument:
+            self.recorder.addToHandler(self.handler)
 
         self.cleanQuit()
 
 
 if __name__ == '__main__':
-    exp = SoundTest()
-    exp.run()
+    files = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    exp = SoundTest(headless='--headless' in sys.argv, filelist=files or None,
+                    instrument='--instrument' in sys.argv,
+                    mockPort='--mock-port' in sys.argv)
+    exp.run(compiled='--compiled' in sys.argv)
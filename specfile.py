@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Validated loading of sound specification csv files.
+
+A spec file is parsed into a typed columnar table with one row per sound,
+Length columns given as (start;stop;n) are expanded up front. The parsed
+table is cached next to the csv, keyed by a hash of its content.
+"""
+from __future__ import division
+import csv
+import hashlib
+import io
+import numpy as np
+
+SPEC_DTYPE = np.dtype([('Frequency', 'f8'), ('Length', 'f8'),
+                       ('Target', 'f8'), ('Repeats', 'i8'), ('Line', 'i8')])
+REQUIRED = ('Frequency', 'Length')
+PARSER_VERSION = 2  # part of the cache key, bump when parsing changes
+
+
+class SpecError(ValueError):
+    '''A problem with a specific row of a spec file'''
+    def __init__(self, filename, line, column, message):
+        super(SpecError, self).__init__(
+            '{} line {}, column {}: {}'.format(filename, line, column,
+                                               message))
+        self.filename = filename
+        self.line = line
+        self.column = column
+
+
+def _number(text, filename, line, column, integer=False):
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        raise SpecError(filename, line, column,
+                        'expected a number, got {!r}'.format(text))
+    if integer and value != int(value):
+        raise SpecError(filename, line, column,
+                        'expected a whole number, got {!r}'.format(text))
+    if not value > 0:
+        raise SpecError(filename, line, column,
+                        'must be positive, got {!r}'.format(text))
+    return value
+
+
+def _length(text, filename, line):
+    """Parse a scalar length or a (start;stop;n) range"""
+    text = text.strip()
+    if text.startswith('(') and text.endswith(')'):
+        parts = text[1:-1].split(';')
+        if len(parts) != 3:
+            raise SpecError(filename, line, 'Length',
+                            'expected (start;stop;n), got {!r}'.format(text))
+        start = _number(parts[0], filename, line, 'Length')
+        stop = _number(parts[1], filename, line, 'Length')
+        count = _number(parts[2], filename, line, 'Length', integer=True)
+        return start, stop, int(count)
+    value = _number(text, filename, line, 'Length')
+    return value, value, 1
+
+
+def parseSpec(text, filename='<spec>'):
+    """Parse spec file content into an expanded table"""
+    reader = csv.DictReader(io.StringIO(text))
+    columns = reader.fieldnames or []
+    for column in REQUIRED:
+        if column not in columns:
+            raise SpecError(filename, 1, column, 'missing column')
+    rows = []
+    lines = []  # line each record ends on, blank lines are skipped
+    for row in reader:
+        rows.append(row)
+        lines.append(reader.line_num)
+    count = len(rows)
+    freqs = np.empty(count)
+    targets = np.full(count, np.nan)
+    repeats = np.ones(count, dtype=np.int64)
+    ranges = np.empty((count, 3))
+    for i, row in enumerate(rows):
+        line = lines[i]
+        if None in row:
+            raise SpecError(filename, line, len(columns) + 1,
+                            'unexpected extra fields {!r}'.format(
+                                row[None]))
+        missing = [column for column in columns if row[column] is None]
+        if missing:
+            raise SpecError(filename, line, missing[0], 'missing field')
+        freqs[i] = _number(row['Frequency'], filename, line, 'Frequency')
+        ranges[i] = _length(row['Length'], filename, line)
+        if row.get('Target') not in (None, ''):
+            targets[i] = _number(row['Target'], filename, line, 'Target')
+        if row.get('Repeats') not in (None, ''):
+            repeats[i] = _number(row['Repeats'], filename, line, 'Repeats',
+                                 integer=True)
+    # Expand the ranges, matching numpy.linspace
+    counts = ranges[:, 2].astype(np.int64)
+    source = np.repeat(np.arange(count), counts)
+    step = np.arange(len(source)) - (np.cumsum(counts) - counts)[source]
+    spans = np.maximum(counts - 1, 1)[source]
+    table = np.empty(len(source), dtype=SPEC_DTYPE)
+    table['Frequency'] = freqs[source]
+    table['Length'] = ranges[source, 0] + (
+        ranges[source, 1] - ranges[source, 0]) * step / spans
+    table['Target'] = targets[source]
+    table['Repeats'] = repeats[source]
+    table['Line'] = np.array(lines, dtype=np.int64)[source]
+    return table
+
+
+def loadSpec(filename, cache=True):
+    """Load a spec file, using the cached table if the content is unchanged"""
+    with open(filename, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content + b'\0' + str(PARSER_VERSION).encode(
+        'ascii')).hexdigest()
+    cachename = filename + '.cache.npz'
+    if cache:
+        try:
+            with np.load(cachename) as cached:
+                if str(cached['digest']) == digest:
+                    return cached['table']
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+    table = parseSpec(content.decode('utf-8-sig'), filename)
+    if cache:
+        try:
+            with open(cachename, 'wb') as f:
+                np.savez(f, digest=np.array(digest), table=table)
+        except (IOError, OSError):
+            pass  # read only location, just skip caching
+    return table
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Batch spectral quality checks of stimulus waveforms.
+
+Stimuli of similar length are zero padded into float32 batches of bounded
+size and analysed with one batched FFT each, giving per stimulus peak
+frequency error, total harmonic distortion, clipping, RMS, DC offset and
+onset/offset transients. A transient shows as an envelope already near full
+level in the first (or last) few ms, OnsetLevel and OffsetLevel are the RMS
+there relative to the RMS of the whole stimulus. Waveforms longer than a
+segment (long wav files) are analysed one at a time: the spectrum and edges
+from a segment at each end, the level measures in chunks over the whole
+file. Levels are for the waveform at full volume, MaxVolume is the highest
+volume that will not clip.
+"""
+from __future__ import division
+import csv
+import numpy as np
+from triallog import openCsv
+from wavfile import openWav
+
+COLUMNS = ['Stimulus', 'Rate', 'Expected', 'Peak', 'FreqError', 'THD',
+           'RMS_dBFS', 'DC', 'MaxVolume', 'Clipped', 'OnsetStep',
+           'OffsetStep', 'OnsetLevel', 'OffsetLevel', 'Problems']
+
+# Limits above which a stimulus is reported as a problem
+limits = dict(FreqError=0.01, THD=1.0, DC=0.01, OnsetStep=0.05,
+              OffsetStep=0.05, OnsetLevel=0.5, OffsetLevel=0.5)
+
+segment = 2 ** 18  # samples analysed at each end of a long waveform
+maxBatch = 2 ** 22  # samples (after FFT padding) analysed together
+
+
+class _Frames(object):
+    '''A long wav file as a sequence of frames, slices are decoded on
+    demand'''
+    def __init__(self, wav):
+        super(_Frames, self).__init__()
+        self.wav = wav
+
+    def __len__(self):
+        return self.wav.frames
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        return self.wav.decode(start, stop)
+
+
+def _length(snd):
+    if hasattr(snd, 'freq'):
+        return snd.samples
+    return openWav(snd.filename).frames  # header only
+
+
+def _waveform(snd, whole=True):
+    """Unscaled waveform and sample rate of a stimulus. Files are mapped
+    from the cache or decoded without being kept on the stimulus, or
+    decoded a slice at a time unless whole"""
+    if not whole and not hasattr(snd, 'freq'):
+        wav = openWav(snd.filename)
+        return _Frames(wav), wav.rate
+    return snd.load(), snd.rate
+
+
+def _mono(waveform):
+    if np.ndim(waveform) == 2:
+        waveform = waveform.mean(axis=1)
+    return np.asarray(waveform, dtype=np.float32)
+
+
+def _fftLength(length):
+    return 1 << int(np.ceil(np.log2(max(length, 2))))
+
+
+def _edgeLevels(table):
+    rms = np.maximum(table['_RMS'], 1e-12)
+    table['OnsetLevel'] = table['_OnsetRMS'] / rms
+    table['OffsetLevel'] = table['_OffsetRMS'] / rms
+
+
+def analyse(waveforms, rates, expected, harmonics=5, edge=0.002):
+    """Check a batch of mono waveforms, expected is the tone frequency of
+    each (NaN for non-tonal stimuli). The envelope is measured over the
+    first and last edge seconds, at most a quarter of the stimulus. Returns
+    a dict of columns"""
+    rates = np.asarray(rates, float)
+    expected = np.asarray(expected, float)
+    lengths = np.array([len(w) for w in waveforms])
+    count, longest = len(waveforms), int(lengths.max())
+    batch = np.zeros((count, longest), dtype=np.float32)
+    for row, waveform in enumerate(waveforms):
+        batch[row, :lengths[row]] = waveform
+    index = np.arange(longest)
+    inside = index < lengths[:, None]
+    rows = np.arange(count)[:, None]
+    # Time domain measures
+    squares = np.square(batch, dtype=np.float64)
+    rms = np.sqrt(squares.sum(axis=1) / lengths)
+    edges = np.maximum(1, np.minimum((edge * rates).astype(int),
+                                     lengths // 4))
+    atOnset = index < edges[:, None]
+    atOffset = inside & (index >= (lengths - edges)[:, None])
+    onsetRms = np.sqrt(np.where(atOnset, squares, 0).sum(axis=1) / edges)
+    offsetRms = np.sqrt(np.where(atOffset, squares, 0).sum(axis=1) / edges)
+    del squares
+    dc = batch.sum(axis=1, dtype=np.float64) / lengths
+    peak = np.abs(batch).max(axis=1)
+    # Clipping shows as runs of identical samples at full scale
+    clipped = ((np.abs(batch[:, 1:]) >= 0.999) &
+               (np.diff(batch, axis=1) == 0)).sum(axis=1)
+    onsetStep = np.abs(batch[:, 0])
+    offsetStep = np.abs(batch[np.arange(count), lengths - 1])
+    # Frequency domain measures on Hann windowed signals
+    window = np.where(inside, 0.5 - 0.5 * np.cos(
+        2 * np.pi * index / np.maximum(lengths - 1, 1)[:, None]), 0)
+    batch *= window
+    del window
+    nfft = _fftLength(longest)
+    spectrum = np.abs(np.fft.rfft(batch, nfft, axis=1))
+    bins = spectrum.shape[1]
+    top = np.argmax(spectrum[:, 1:], axis=1) + 1
+    # Parabolic interpolation of the peak on log magnitudes
+    near = np.log(spectrum[rows, np.clip(top[:, None] + [-1, 0, 1], 0,
+                                         bins - 1)] + 1e-20)
+    curve = near[:, 0] - 2 * near[:, 1] + near[:, 2]
+    shift = np.where(curve < 0, 0.5 * (near[:, 0] - near[:, 2]) /
+                     np.where(curve < 0, curve, -1), 0)
+    peakFreq = (top + shift) * rates / nfft
+    # Harmonic power, taking the largest bin within two of each harmonic
+    order = np.arange(1, harmonics + 1)
+    centres = np.round(order * (top + shift)[:, None]).astype(int)
+    around = centres[:, :, None] + np.arange(-2, 3)
+    valid = around[:, :, 2] < bins - 2
+    power = spectrum[rows[:, :, None], np.clip(around, 0, bins - 1)].max(
+        axis=2).astype(np.float64) ** 2 * valid
+    thd = 100 * np.sqrt(power[:, 1:].sum(axis=1)) / np.sqrt(power[:, 0])
+    tonal = ~np.isnan(expected)
+    table = dict(
+        Rate=rates, Expected=expected, Peak=peakFreq,
+        FreqError=np.where(tonal, np.abs(peakFreq - expected) / expected,
+                           np.nan),
+        THD=np.where(tonal, thd, np.nan),
+        RMS_dBFS=20 * np.log10(np.maximum(rms, 1e-12)), DC=dc,
+        MaxVolume=np.minimum(1.0, 1.0 / np.maximum(peak, 1e-12)),
+        Clipped=clipped, OnsetStep=onsetStep, OffsetStep=offsetStep,
+        # Linear levels, to combine segments
+        _RMS=rms, _OnsetRMS=onsetRms, _OffsetRMS=offsetRms)
+    _edgeLevels(table)
+    _flag(table)
+    return table
+
+
+def _flag(table):
+    """Fill in the Problems column from the limits"""
+    failed = [np.abs(np.nan_to_num(table[name])) > limit
+              for name, limit in sorted(limits.items())] + \
+        [np.asarray(table['Clipped']) > 0]
+    names = sorted(limits) + ['Clipped']
+    table['Problems'] = [' '.join(name for name, fail in zip(names, failed)
+                                  if fail[row])
+                         for row in range(len(table['Rate']))]
+
+
+def analyseLong(waveform, rate, expected, chunk=2 ** 20):
+    """Check one long waveform without holding more than a chunk of it as
+    float32 at a time. The spectrum and onset come from a segment at the
+    start, the offset from a segment at the end, edge levels are relative
+    to the RMS of the whole waveform"""
+    ends = analyse([_mono(waveform[:segment]), _mono(waveform[-segment:])],
+                   [rate, rate], [expected, expected])
+    table = dict((name, ends[name][:1]) for name in ends
+                 if name != 'Problems')
+    table['OffsetStep'] = ends['OffsetStep'][1:]
+    table['_OffsetRMS'] = ends['_OffsetRMS'][1:]
+    # Level measures over the whole waveform, chunks overlap by a sample
+    # so runs of clipped samples are seen across chunk boundaries
+    squares = total = peak = clipped = 0.0
+    for start in range(0, len(waveform), chunk):
+        block = _mono(waveform[max(start - 1, 0):start + chunk])
+        new = block[1:] if start else block
+        squares += np.square(new, dtype=np.float64).sum()
+        total += new.sum(dtype=np.float64)
+        peak = max(peak, np.abs(new).max())
+        clipped += ((np.abs(block[1:]) >= 0.999) &
+                    (np.diff(block) == 0)).sum()
+    rms = np.sqrt(squares / len(waveform))
+    table['_RMS'] = np.array([rms])
+    _edgeLevels(table)
+    table['RMS_dBFS'] = np.array([20 * np.log10(max(rms, 1e-12))])
+    table['DC'] = np.array([total / len(waveform)])
+    table['MaxVolume'] = np.array([min(1.0, 1.0 / max(peak, 1e-12))])
+    table['Clipped'] = np.array([int(clipped)])
+    _flag(table)
+    return table
+
+
+def _batches(lengths, batchSize):
+    """Lists of stimulus indices to analyse together, shortest first. Long
+    waveforms come on their own"""
+    batch = []
+    for i in np.argsort(lengths, kind='stable'):
+        if lengths[i] > 2 * segment:
+            yield [i]
+            continue
+        if batch and (len(batch) == batchSize or
+                      (len(batch) + 1) * _fftLength(lengths[i]) > maxBatch):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def checkStimuli(sounds, files=True, batchSize=64):
+    """Check stimuli of similar length together, at most batchSize and
+    maxBatch padded samples at a time so memory stays bounded, and long
+    waveforms one at a time. files=False skips file based stimuli, whose
+    checking means reading them in full (see batch.py prepare). Returns a
+    dict of columns in the order of sounds"""
+    sounds = [snd for snd in sounds if files or hasattr(snd, 'freq')]
+    lengths = [_length(snd) for snd in sounds]
+    parts = []
+    order = []
+    for batch in _batches(lengths, batchSize):
+        chunk = [sounds[i] for i in batch]
+        expected = [_expected(snd) for snd in chunk]
+        if lengths[batch[0]] > 2 * segment:
+            waveform, rate = _waveform(chunk[0], whole=False)
+            parts.append(analyseLong(waveform, rate, expected[0]))
+        else:
+            waveforms, rates = zip(*[_waveform(snd) for snd in chunk])
+            parts.append(analyse([_mono(w) for w in waveforms], rates,
+                                 expected))
+        order.extend(batch)
+    restore = np.argsort(order)
+    table = dict((column, np.concatenate([part[column] for part in parts]
+                                         or [np.zeros(0)])[restore])
+                 for column in COLUMNS[1:-1])
+    issues = sum((part['Problems'] for part in parts), [])
+    table['Problems'] = [issues[i] for i in restore]
+    table['Stimulus'] = [str(snd) for snd in sounds]
+    return table
+
+
+def _expected(snd):
+    return float(snd.freq) if hasattr(snd, 'freq') else np.nan
+
+
+def problems(table):
+    """(stimulus, problems) for every stimulus that failed a check"""
+    return [(name, issue) for name, issue in zip(table['Stimulus'],
+                                                  table['Problems']) if issue]
+
+
+def writeReport(filename, table):
+    with openCsv(filename) as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(zip(*[table[column] for column in COLUMNS]))
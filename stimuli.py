@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Stimulus definitions shared by the calibration and sound test scripts.
+
+A session's stimuli are held in a StimulusTable, one structured array row
+per stimulus addressed by its integer id (its position), with all generated
+tones rendered into one shared buffer. Indexing the table gives lightweight
+views with the attributes the scripts use.
+
+Every stimulus has a volume and a gain per output channel (left, right).
+Equal channel levels play the mono waveform, otherwise the waveform is
+mixed to stereo in one broadcast multiply, never re-synthesised.
+
+psychopy.sound is only imported when a sound is first played, so stimuli
+can be rendered and checked without an audio library (e.g. by batch.py).
+psychopy.prefs must be configured before then.
+"""
+from __future__ import division
+import os
+from math import isnan
+import numpy as np
+from collections import OrderedDict
+from tonebank import ToneBank, RAMP
+from wavecache import WaveformCache
+from wavfile import openWav
+from specfile import SPEC_DTYPE
+
+maxSoundBytes = 64 * 2 ** 20  # psychopy sounds kept ready over all stimuli
+
+STIMULUS_DTYPE = np.dtype([('Frequency', '<f8'), ('Duration', '<f8'),
+                           ('Target', '<f8'), ('Repeats', '<i4'),
+                           ('Gain', '<f8'), ('Channels', '<f8', (2,)),
+                           ('Offset', '<i8'), ('Samples', '<i8')])
+
+
+def channelLevels(volume, channels):
+    """Output level of each channel, or a single level if they are equal"""
+    levels = tuple(round(volume * gain, 6) for gain in channels)
+    return levels[0] if len(set(levels)) == 1 else levels
+
+
+def mixChannels(waveform, levels):
+    """Scale a waveform to a level, or to per channel levels giving a frames
+    x channels array (mono waveforms are spread over the channels)"""
+    if np.isscalar(levels):
+        return waveform * levels
+    levels = np.asarray(levels, dtype=np.float32)
+    if np.ndim(waveform) == 1:
+        waveform = waveform[:, None]
+    return waveform * levels
+
+
+class SoundCache(object):
+    '''psychopy sounds of recently used stimuli and levels within a byte
+    budget shared by every stimulus, least recently used dropped first. A
+    stimulus is released (see SoundFromFile.release) once none of its sounds
+    are cached'''
+    def __init__(self, maxBytes=maxSoundBytes):
+        super(SoundCache, self).__init__()
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self._entries = OrderedDict()  # (stimulus, level) -> (sound, bytes)
+        self._stimuli = {}  # stimulus key -> [stimulus, cached levels]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Cached sound for a (stimulus key, level), or None"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry  # most recently used
+        return entry[0]
+
+    def put(self, key, psound, nbytes, snd):
+        self._entries[key] = (psound, nbytes)
+        self._stimuli.setdefault(key[0], [snd, 0])[1] += 1
+        self.nbytes += nbytes
+        while self.nbytes > self.maxBytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self.nbytes -= self._entries.pop(key)[1]
+        stimulus = self._stimuli[key[0]]
+        stimulus[1] -= 1
+        if not stimulus[1]:
+            del self._stimuli[key[0]]
+            stimulus[0].release()
+
+    def clear(self):
+        while self._entries:
+            self._drop(next(iter(self._entries)))
+
+
+soundCache = SoundCache()
+
+
+def _cachedSound(snd, gained=None):
+    """psychopy sound for snd at its current volume and channel gains from
+    the shared sound cache, the unscaled waveform is generated once and
+    level changes only apply gain to it. gained is the waveform already
+    mixed to the levels if it has been prepared (see prefetch)"""
+    from psychopy import sound
+    key = snd.soundKey, channelLevels(snd.volume, snd.channels)
+    psound = soundCache.get(key)
+    if psound is None:
+        if gained is None:
+            if snd.waveform is None:
+                snd._generate()
+            gained = mixChannels(snd.waveform, key[1])
+        psound = sound.Sound(value=gained, sampleRate=snd.rate,
+                             hamming=False)
+        soundCache.put(key, psound, gained.nbytes, snd)
+    return psound
+
+
+class SoundSpec(object):
+    def __init__(self):
+        self.waveform = None
+        self.rate = None
+        self.volume = 1.0
+        self.channels = (1.0, 1.0)
+        self.cache = None
+
+    @property
+    def soundKey(self):
+        """Identifies this stimulus in the sound cache"""
+        return id(self)
+
+    @property
+    def sound(self):
+        """return a sound at the current volume"""
+        return _cachedSound(self)
+
+    def getSound(self, gained=None):
+        """sound at the current volume, built from gained if not cached"""
+        return _cachedSound(self, gained)
+
+    @property
+    def cached(self):
+        """Whether a sound at the current volume is ready"""
+        return (self.soundKey, channelLevels(self.volume, self.channels)) \
+            in soundCache
+
+    def load(self):
+        """The unscaled waveform, generated if needed"""
+        if self.waveform is None:
+            self._generate()
+        return self.waveform
+
+    def release(self):
+        """Called once no sound of this stimulus is cached"""
+        pass
+
+
+class SoundFromFile(SoundSpec):
+    '''Holds a sound file and generates psychopy sound object as needed'''
+    def __init__(self, filename=None, target=None, repeats=1):
+        super(SoundFromFile, self).__init__()
+        self.filename = filename
+        self.target = target
+        self.repeats = int(repeats)
+        self.wav = None
+
+    def cacheKey(self):
+        stat = os.stat(self.filename)
+        return WaveformCache.key(kind='file',
+                                 path=os.path.abspath(self.filename),
+                                 mtime=stat.st_mtime, size=stat.st_size)
+
+    def load(self):
+        """The decoded waveform without keeping it, mapped from the cache if
+        batch.py prepare stored it. Decoding is shared with anything still
+        holding the same file's samples"""
+        if self.wav is None:
+            self.wav = openWav(self.filename)  # header only, no decoding
+        self.rate = self.wav.rate
+        if self.waveform is not None:
+            return self.waveform
+        waveform = None
+        if self.cache is not None:
+            waveform = self.cache.get(self.cacheKey())
+        return self.wav.samples if waveform is None else waveform
+
+    def _generate(self):
+        """Decode on first play, kept until released"""
+        self.waveform = self.load()
+
+    def release(self):
+        """Drop the decoded waveform once none of this file's sounds are
+        cached, it is decoded again when next played"""
+        self.waveform = None
+
+    def __eq__(self, other):
+        if not isinstance(other, SoundFromFile):
+            return NotImplemented
+        return (self.filename == other.filename and
+                self.target == other.target and
+                self.repeats == other.repeats)
+
+    def __hash__(self):
+        return hash((self.filename, self.target, self.repeats))
+
+    def __str__(self):
+        return self.filename
+
+
+def _target(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class StimulusTable(object):
+    '''All stimuli of a session as one structured array (see STIMULUS_DTYPE)
+    indexed by integer stimulus id, file based sounds first and then the
+    generated tones. Indexing gives the SoundFromFile of a file row and a
+    StimulusView of a tone row'''
+    def __init__(self, specs=(), files=(), rate=48000):
+        """specs is a sequence of SPEC_DTYPE arrays (see specfile), files a
+        sequence of SoundFromFile"""
+        super(StimulusTable, self).__init__()
+        self.rate = rate
+        self.files = list(files)
+        specs = np.concatenate([np.zeros(0, SPEC_DTYPE)] + list(specs))
+        count = len(self.files)
+        self.data = np.zeros(count + len(specs), STIMULUS_DTYPE)
+        self.data['Gain'] = 1.0
+        self.data['Channels'] = 1.0
+        self.data['Offset'] = -1
+        files, tones = self.data[:count], self.data[count:]
+        files['Frequency'] = files['Duration'] = np.nan
+        files['Target'] = [_target(snd.target) for snd in self.files]
+        files['Repeats'] = [snd.repeats for snd in self.files]
+        tones['Frequency'] = specs['Frequency']
+        tones['Duration'] = specs['Length']
+        tones['Target'] = specs['Target']
+        tones['Repeats'] = specs['Repeats']
+        tones['Samples'] = np.round(specs['Length'] * rate)
+        tones['Offset'] = np.cumsum(tones['Samples']) - tones['Samples']
+        self.buffer = None
+
+    @property
+    def generated(self):
+        """Ids of the generated tones"""
+        return np.arange(len(self.files), len(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('stimulus id out of range')
+        if index < len(self.files):
+            return self.files[index]
+        return StimulusView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def setGain(self, gain):
+        """Set the volume of every stimulus"""
+        self.data['Gain'] = gain
+        for snd in self.files:
+            snd.volume = gain
+
+    def render(self, cache=None):
+        """Fill the shared buffer with every generated tone, loading what is
+        cached and synthesising the rest in place with the tone bank. File
+        based sounds are attached to the cache and decoded on first use"""
+        for snd in self.files:
+            snd.cache = cache
+        tones = self.data[len(self.files):]
+        self.buffer = np.empty(int(tones['Samples'].sum()), dtype=np.float32)
+        missing = []
+        for index in self.generated:
+            view = StimulusView(self, index)
+            waveform = cache.get(view.cacheKey()) if cache else None
+            if waveform is None or len(waveform) != view.samples:
+                missing.append(index)
+            else:
+                view.waveform[:] = waveform
+        if missing:
+            # Synthesised straight into the rows of the shared buffer
+            rows = self.data[missing]
+            bank = ToneBank(rate=self.rate)
+            for index, waveform in zip(missing, bank.build(
+                    rows['Frequency'], rows['Duration'], out=self.buffer,
+                    offsets=rows['Offset'])):
+                if cache is not None:
+                    cache.put(StimulusView(self, index).cacheKey(), waveform)
+        if cache is not None:
+            cache.evict()
+        return self
+
+
+class StimulusView(object):
+    '''A generated tone row of a StimulusTable, with the attributes of a
+    sound but no per stimulus state of its own'''
+    __slots__ = ('table', 'id')
+
+    def __init__(self, table, id):
+        self.table = table
+        self.id = id
+
+    def _get(self, column):
+        return self.table.data[column][self.id]
+
+    @property
+    def freq(self):
+        return _plain(float(self._get('Frequency')))
+
+    @property
+    def dur(self):
+        return float(self._get('Duration'))
+
+    @property
+    def target(self):
+        target = float(self._get('Target'))
+        return None if isnan(target) else _plain(target)
+
+    @property
+    def repeats(self):
+        return int(self._get('Repeats'))
+
+    @property
+    def samples(self):
+        return int(self._get('Samples'))
+
+    @property
+    def volume(self):
+        return float(self._get('Gain'))
+
+    @volume.setter
+    def volume(self, value):
+        self.table.data['Gain'][self.id] = value
+
+    @property
+    def channels(self):
+        return tuple(self._get('Channels').tolist())
+
+    @channels.setter
+    def channels(self, gains):
+        self.table.data['Channels'][self.id] = gains
+
+    @property
+    def rate(self):
+        return self.table.rate
+
+    @property
+    def waveform(self):
+        """View into the table's shared buffer, None until rendered"""
+        if self.table.buffer is None:
+            return None
+        offset = int(self._get('Offset'))
+        return self.table.buffer[offset:offset + self.samples]
+
+    def _generate(self):
+        self.table.render()
+
+    @property
+    def soundKey(self):
+        """Identifies this stimulus in the sound cache"""
+        return id(self.table), self.id
+
+    @property
+    def sound(self):
+        """return a sound at the current volume"""
+        return _cachedSound(self)
+
+    def getSound(self, gained=None):
+        """sound at the current volume, built from gained if not cached"""
+        return _cachedSound(self, gained)
+
+    @property
+    def cached(self):
+        """Whether a sound at the current volume is ready"""
+        return (self.soundKey, channelLevels(self.volume, self.channels)) \
+            in soundCache
+
+    def load(self):
+        """The unscaled waveform, rendering the table if needed"""
+        if self.table.buffer is None:
+            self.table.render()
+        return self.waveform
+
+    def release(self):
+        pass  # the shared buffer is kept for the whole session
+
+    def cacheKey(self, rate=None):
+        return WaveformCache.key(kind='tone', freq=float(self.freq),
+                                 dur=self.dur, rate=rate or self.rate,
+                                 channels=1, ramp=RAMP)
+
+    def __eq__(self, other):
+        if not isinstance(other, StimulusView):
+            return NotImplemented
+        return self.table is other.table and self.id == other.id
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((id(self.table), self.id))
+
+    def __str__(self):
+        return 'Freq:({0.freq}), Duration:({0.dur})'.format(self)
+
+
+def _plain(value):
+    """Whole numbers as ints so sounds print as they are written in the csv"""
+    return int(value) if value == int(value) else value
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import numpy as np
+import pytest
+from caltable import CalTable, writeTable
+from specfile import loadSpec
+
+SPEC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'calsounds.csv')
+
+
+def _volume(freq, dur):
+    """A smooth calibration surface, log linear in both axes"""
+    return 0.3 * (freq / 613) ** 0.5 * (dur / 0.1) ** -0.25
+
+
+@pytest.fixture
+def grid():
+    spec = loadSpec(SPEC, cache=False)
+    return spec['Frequency'], spec['Length'], spec['Target']
+
+
+def test_full_grid_lookup_and_interpolate(tmpdir, grid):
+    freqs, durs, targets = grid
+    filename = str(tmpdir.join('full.cal'))
+    writeTable(filename, freqs, durs, targets, _volume(freqs, durs))
+    table = CalTable(filename)
+    assert table.volumes.shape == (1, 8, 7)
+    assert table.lookup(613, 0.1, 75) == pytest.approx(0.3)
+    assert table.interpolate(613, 0.1, 75) == pytest.approx(0.3)
+    # Log linear in both axes, so exact between grid points too
+    assert table.interpolate(650, 0.12) == pytest.approx(_volume(650, 0.12),
+                                                         rel=1e-5)
+    # Clamped at the edges
+    assert table.interpolate(100, 0.1) == pytest.approx(0.3)
+
+
+def test_interpolate_next_to_holes(tmpdir, grid):
+    freqs, durs, targets = grid
+    keep = np.arange(len(freqs)) % 2 == 0  # every other point marked
+    filename = str(tmpdir.join('sparse.cal'))
+    writeTable(filename, freqs[keep], durs[keep], targets[keep],
+               _volume(freqs[keep], durs[keep]))
+    table = CalTable(filename)
+    assert np.isnan(table.volumes).any()
+    for freq, dur in zip(freqs[keep], durs[keep]):
+        assert table.interpolate(freq, dur, 75) == pytest.approx(
+            table.lookup(freq, dur, 75), rel=1e-6)
+    assert table.interpolate(613, 0.1, 75) == pytest.approx(0.3)
+    # Clamped to a marked edge point
+    assert table.interpolate(600, 0.05, 75) == pytest.approx(0.3)
+    # A hole that is needed is an error rather than NaN
+    assert np.isnan(table.lookup(613, 0.15, 75))
+    with pytest.raises(ValueError):
+        table.interpolate(613, 0.15, 75)
+    with pytest.raises(ValueError):
+        table.interpolate(650, 0.12, 75)
+
+
+def test_zero_volume_corner(tmpdir):
+    filename = str(tmpdir.join('zero.cal'))
+    writeTable(filename, [500, 1000], [0.1, 0.1], [70, 70], [0.0, 0.5])
+    table = CalTable(filename)
+    assert table.interpolate(1000, 0.1) == pytest.approx(0.5)
+    with pytest.raises(ValueError):
+        table.interpolate(700, 0.1)
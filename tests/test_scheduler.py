@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import csv
+import pytest
+from scheduler import TrialScheduler, MockPort, NullAudio
+from instrument import PhaseRecorder
+from triallog import EventLog, convertEventLog
+
+
+class FailingAudio(object):
+    def play(self, stimulus):
+        raise IOError('audio device lost')
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = TrialScheduler(MockPort(), NullAudio(), events=[])
+    yield scheduler
+    scheduler.close()
+
+
+def test_trials_play_in_order_and_complete(scheduler):
+    start = scheduler.clock() + 0.02
+    trials = [scheduler.playTrial(0.01, when=start + 0.03 * i, code=i + 1)
+              for i in range(3)]
+    for trial in trials:
+        assert trial.wait(2)
+    played = [trial.played for trial in trials]
+    assert played == sorted(played)
+    for i, trial in enumerate(trials):
+        assert trial.played >= start + 0.03 * i
+        assert trial.completed >= trial.played + 0.01
+    assert [event for _, event, _ in scheduler.events].count('play') == 3
+
+
+def test_port_codes_are_raised_and_cleared(scheduler):
+    port = scheduler.port
+    when = scheduler.clock() + 0.01
+    scheduler.trigger(5, when=when, duration=0.005)
+    done = scheduler.playTrial(0.0, when=when + 0.05, code=None)
+    done.wait(2)
+    values = [value for _, value in port.writes]
+    assert values == [5, 0]
+    (raised, _), (cleared, _) = port.writes
+    # Actions never run early, how late they are depends on the machine
+    assert when <= raised <= cleared
+    assert cleared >= when + 0.005
+
+
+def test_failing_action_is_raised_on_the_waiting_thread():
+    scheduler = TrialScheduler(MockPort(), FailingAudio(), events=[])
+    try:
+        trial = scheduler.playTrial(0.01)
+        with pytest.raises(IOError):
+            trial.wait(2)
+        assert trial.done.is_set()
+        assert any(event == 'error' for _, event, _ in scheduler.events)
+        with pytest.raises(IOError):
+            scheduler.playTrial(0.01)
+        # The worker survives the error
+        assert scheduler._thread.is_alive()
+    finally:
+        scheduler.close()
+
+
+def test_recorder_marks_phases_of_indexed_trials():
+    recorder = PhaseRecorder(capacity=64)
+    scheduler = TrialScheduler(MockPort(), NullAudio(), recorder=recorder)
+    try:
+        scheduler.playTrial(0.005, index=0).wait(2)
+        scheduler.playTrial(0.005).wait(2)
+    finally:
+        scheduler.close()
+    trials, intervals = recorder.intervals()
+    assert list(trials) == [0]
+    assert intervals['completion'][0] >= 0.005
+
+
+def test_events_are_logged_to_an_event_log(tmpdir):
+    filename = str(tmpdir.join('run.events'))
+    log = EventLog(filename, chunk=4)
+    scheduler = TrialScheduler(MockPort(), NullAudio(), events=log)
+    try:
+        for i in range(3):
+            scheduler.playTrial(0.005, code=i + 1).wait(2)
+    finally:
+        scheduler.close()
+    log.close()
+    convertEventLog(filename, str(tmpdir.join('events.csv')))
+    with open(str(tmpdir.join('events.csv'))) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['Time', 'Event', 'Value']
+    assert [row[1] for row in rows[1:]].count('play') == 3
+    assert len(rows) - 1 == len(log)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Batched sine synthesis for generated stimuli.
+
+Every tone of a stimulus list is rendered with a few NumPy passes into one
+float32 buffer, individual sounds are views into that buffer. The buffer can
+be supplied, so tones are synthesised in place without an extra copy.
+"""
+from __future__ import division
+import numpy as np
+
+RAMP = 0.005  # seconds of raised cosine at onset and offset
+block = 2 ** 20  # samples synthesised per pass, bounds the temporary arrays
+
+
+class ToneBank(object):
+    '''Synthesises a list of tones into a single shared buffer'''
+    def __init__(self, rate=48000, ramp=RAMP):
+        super(ToneBank, self).__init__()
+        self.rate = rate
+        self.ramp = ramp
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+
+    def build(self, freqs, durs, out=None, offsets=None):
+        """Synthesise one tone per (frequency, duration) pair and return a
+        list of views into the shared buffer. out is a float32 buffer to
+        synthesise into instead of a new one, offsets where each tone starts
+        in it (packed one after the other if None)"""
+        freqs = np.asarray(freqs, dtype=np.float64)
+        lengths = np.round(np.asarray(durs, dtype=np.float64) *
+                           self.rate).astype(np.int64)
+        if offsets is None:
+            offsets = np.zeros_like(lengths)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if out is None:
+            out = np.empty(int((offsets + lengths).max()) if len(lengths)
+                           else 0, dtype=np.float32)
+        for first, last in _passes(offsets, lengths):
+            start = offsets[first]
+            self._synthesise(freqs[first:last], lengths[first:last],
+                             out[start:offsets[last - 1] + lengths[last - 1]])
+        self.buffer = out
+        self.offsets = offsets
+        self.lengths = lengths
+        return [out[o:o + n] for o, n in zip(offsets, lengths)]
+
+    def _synthesise(self, freqs, lengths, out):
+        """Write tones packed one after the other into out"""
+        offsets = np.cumsum(lengths) - lengths
+        # Position of every sample within its own tone
+        stim = np.repeat(np.arange(len(lengths)), lengths)
+        local = np.arange(len(out)) - offsets[stim]
+        np.sin(2 * np.pi * freqs[stim] / self.rate * local, out=out)
+        # Raised cosine ramps, never longer than half a tone
+        ramps = np.minimum(int(round(self.ramp * self.rate)), lengths // 2)
+        edge = np.minimum(local, lengths[stim] - 1 - local)
+        inramp = edge < ramps[stim]
+        out[inramp] *= 0.5 - 0.5 * np.cos(
+            np.pi * edge[inramp] / ramps[stim][inramp])
+
+
+def _passes(offsets, lengths):
+    """(first, last) tone ranges that are contiguous in the buffer and at
+    most block samples long, unless a single tone is longer"""
+    first, size = 0, 0
+    for i in range(len(lengths)):
+        if i > first and (offsets[i] != offsets[i - 1] + lengths[i - 1] or
+                          size + lengths[i] > block):
+            yield first, i
+            first, size = i, 0
+        size += lengths[i]
+    if len(lengths):
+        yield first, len(lengths)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar, chunked logging of sound test trials and scheduler events.
+
+Trials are written into a preallocated structured array and appended to a
+binary file a chunk at a time, so memory stays bounded and adding a trial
+is a single row store. A crash loses at most the unflushed chunk. The log
+is converted to the ExperimentHandler style csv afterwards. EventLog does
+the same for the scheduler's event log (see scheduler.TrialScheduler).
+
+Layout (little endian):
+    b'TLOG', uint32 version, uint32 header length
+    json header {"dtype": record description, "stimuli": names} or
+        {"dtype": record description, "events": names}
+    records
+
+    python triallog.py run.trials [out.csv]
+"""
+from __future__ import division, print_function
+import csv
+import json
+import os
+import struct
+import sys
+import numpy as np
+
+MAGIC = b'TLOG'
+VERSION = 1
+_HEADER = struct.Struct('<4sII')
+RECORD_DTYPE = np.dtype([('Trial', '<i8'), ('Stimulus', '<i4'),
+                         ('Repeat', '<i4'), ('Sample', '<i8'),
+                         ('Timestamp', '<f8'), ('Played', '<f8'),
+                         ('Completed', '<f8'), ('Code', '<i2')])
+EVENT_DTYPE = np.dtype([('Time', '<f8'), ('Event', '<i2'),
+                        ('Value', '<i8')])
+EVENTS = ['port', 'play', 'complete', 'error']
+
+
+class _ChunkedLog(object):
+    '''Structured records appended to a file every chunk records'''
+    def __init__(self, filename, dtype, header, chunk):
+        super(_ChunkedLog, self).__init__()
+        self.filename = filename
+        self._chunk = np.zeros(chunk, dtype=dtype)
+        self._fill = 0
+        self.count = 0
+        header = json.dumps(dict(header, dtype=dtype.descr)).encode('utf-8')
+        self._file = open(filename, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, len(header)))
+        self._file.write(header)
+
+    def _add(self, record):
+        self._chunk[self._fill] = record
+        self._fill += 1
+        self.count += 1
+        if self._fill == len(self._chunk):
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._chunk[:self._fill].tobytes())
+        self._file.flush()
+        self._fill = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __len__(self):
+        return self.count
+
+
+class TrialLog(_ChunkedLog):
+    '''Append-only trial log flushed to disk every chunk trials'''
+    def __init__(self, filename, stimuli=(), chunk=4096):
+        """stimuli are the stimulus names, indexed by stimulus id"""
+        super(TrialLog, self).__init__(
+            filename, RECORD_DTYPE,
+            dict(stimuli=[u'{}'.format(name) for name in stimuli]), chunk)
+
+    def add(self, stimulus, repeat, timestamp, played=np.nan,
+            completed=np.nan, code=0, sample=-1):
+        """Log one trial"""
+        self._add((self.count, stimulus, repeat, sample, timestamp, played,
+                   completed, code))
+
+    def extend(self, stimulus, repeat, timestamp, played=np.nan,
+               completed=np.nan, code=0, sample=-1):
+        """Log many trials given as columns (scalars are broadcast)"""
+        columns = np.broadcast_arrays(stimulus, repeat, sample, timestamp,
+                                      played, completed, code)
+        start = 0
+        while start < len(columns[0]):
+            size = min(len(columns[0]) - start, len(self._chunk) - self._fill)
+            rows = self._chunk[self._fill:self._fill + size]
+            rows['Trial'] = np.arange(self.count, self.count + size)
+            for name, column in zip(RECORD_DTYPE.names[1:], columns):
+                rows[name] = column[start:start + size]
+            self._fill += size
+            self.count += size
+            start += size
+            if self._fill == len(self._chunk):
+                self.flush()
+
+
+class EventLog(_ChunkedLog):
+    '''Append-only scheduler event log flushed to disk every chunk events.
+    Takes the (time, event, value) tuples of TrialScheduler, a value of
+    None is stored as -1'''
+    def __init__(self, filename, chunk=4096):
+        super(EventLog, self).__init__(filename, EVENT_DTYPE,
+                                       dict(events=EVENTS), chunk)
+
+    def append(self, event):
+        when, name, value = event
+        self._add((when, EVENTS.index(name), -1 if value is None else value))
+
+
+def openCsv(filename):
+    """Open a csv file for csv.writer, without the blank row after every
+    row that text mode newline translation gives on Windows"""
+    if sys.version_info[0] < 3:
+        return open(filename, 'wb')
+    return open(filename, 'w', newline='')
+
+
+def _readLog(filename):
+    """Header and memory-mapped records of a log, ignoring any partly
+    written last record"""
+    with open(filename, 'rb') as f:
+        magic, version, length = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a trial log: ' + filename)
+        header = json.loads(f.read(length).decode('utf-8'))
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    offset = _HEADER.size + length
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if not count:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                             shape=(count,))
+
+
+def readTrialLog(filename):
+    """Stimulus names and memory-mapped records of a trial log"""
+    header, records = _readLog(filename)
+    return header['stimuli'], records
+
+
+def convertTrialLog(filename, csvname, chunk=65536):
+    """Write a trial log as the csv ExperimentHandler would have written,
+    one row per trial. Columns with nothing logged are left out"""
+    stimuli, records = readTrialLog(filename)
+    columns = [('Snd', 'Repeat'), ('Stimulus', 'Stimulus'),
+               ('Sample', 'Sample'), ('Timestamp', 'Timestamp'),
+               ('Played', 'Played'), ('Completed', 'Completed'),
+               ('Code', 'Code')]
+    empty = dict(Sample=lambda values: (values < 0).all(),
+                 Played=lambda values: np.isnan(values).all(),
+                 Completed=lambda values: np.isnan(values).all())
+    columns = [(title, name) for title, name in columns
+               if name not in empty or not empty[name](records[name])]
+    names = np.array(stimuli + [''], dtype=object)
+    with openCsv(csvname) as f:
+        writer = csv.writer(f)
+        writer.writerow([title for title, _ in columns])
+        for start in range(0, len(records), chunk):
+            block = records[start:start + chunk]
+            writer.writerows(zip(*[
+                names[block[name]] if name == 'Stimulus' else
+                block[name].tolist() for _, name in columns]))
+    return len(records)
+
+
+def convertEventLog(filename, csvname, chunk=65536):
+    """Write an event log as csv, one row per event. Values of -1 are left
+    blank"""
+    header, records = _readLog(filename)
+    names = np.array(header['events'], dtype=object)
+    with openCsv(csvname) as f:
+        writer = csv.writer(f)
+        writer.writerow(['Time', 'Event', 'Value'])
+        for start in range(0, len(records), chunk):
+            block = records[start:start + chunk]
+            values = np.where(block['Value'] < 0, '',
+                              block['Value'].astype(str))
+            writer.writerows(zip(block['Time'].tolist(),
+                                 names[block['Event']], values.tolist()))
+    return len(records)
+
+
+if __name__ == '__main__':
+    source = sys.argv[1]
+    target = sys.argv[2] if len(sys.argv) > 2 else \
+        os.path.splitext(source)[0] + '.csv'
+    print('{} trials written to {}'.format(convertTrialLog(source, target),
+                                           target))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed on-disk cache of rendered stimulus waveforms.
+
+Waveforms are stored as .npy files named by a hash of everything that
+determines their content and are loaded back memory-mapped. The cache is
+kept under a size budget by evicting the least recently used entries.
+"""
+from __future__ import division
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+class WaveformCache(object):
+    '''Persistent store of float32 waveforms keyed by their parameters'''
+    def __init__(self, directory='data/cache', maxBytes=512 * 2 ** 20):
+        super(WaveformCache, self).__init__()
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(**params):
+        """Hash a set of rendering parameters into a cache key"""
+        text = repr(sorted(params.items())).encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """Return a memory-mapped waveform, or None if it isn't cached"""
+        path = self._path(key)
+        try:
+            waveform = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used for eviction
+        except OSError:
+            pass  # evicted by another process, the mapping stays valid
+        return waveform
+
+    def put(self, key, waveform):
+        """Store a waveform, written to a temporary file then renamed so a
+        partial write is never picked up. Several processes and threads may
+        share a cache directory"""
+        path = self._path(key)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                    threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(waveform, dtype=np.float32))
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)  # another writer stored the same waveform
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries until within maxBytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue  # still mapped elsewhere, try the next one
+            total -= size
+        return total
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped, lazily decoded wav file access.
+
+Only the RIFF header is read when a file is opened, sample data is mapped
+from disk and decoded to float32 the first time it is asked for. Files are
+shared through a registry so entries pointing at the same file (e.g. with
+different dB targets) share one decoded buffer while any of them holds it.
+"""
+from __future__ import division
+import os
+import struct
+import threading
+import weakref
+import numpy as np
+
+PCM = 1
+FLOAT = 3
+EXTENSIBLE = 0xFFFE
+
+_registry = weakref.WeakValueDictionary()
+_registryLock = threading.Lock()
+
+
+class WavFile(object):
+    '''A PCM or float wav file with lazily decoded sample data'''
+    def __init__(self, filename):
+        super(WavFile, self).__init__()
+        self.filename = filename
+        self._samples = None
+        self._lock = threading.Lock()
+        self._readHeader()
+
+    def _readHeader(self):
+        """Walk the RIFF chunks to find the format and the data offset"""
+        with open(self.filename, 'rb') as f:
+            riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                raise ValueError('Not a wav file: ' + self.filename)
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError('No data chunk in ' + self.filename)
+                chunk, size = struct.unpack('<4sI', header)
+                if chunk == b'fmt ':
+                    fmt = f.read(size)
+                elif chunk == b'data':
+                    self.offset = f.tell()
+                    self.nbytes = size
+                    break
+                else:
+                    f.seek(size, 1)
+                if size % 2:
+                    f.seek(1, 1)  # chunks are word aligned
+        if fmt is None:
+            raise ValueError('No format chunk in ' + self.filename)
+        tag, self.channels, self.rate, _, _, bits = struct.unpack(
+            '<HHIIHH', fmt[:16])
+        if tag == EXTENSIBLE:
+            tag = struct.unpack('<H', fmt[24:26])[0]
+        self.width = bits // 8
+        if (tag, self.width) not in ((PCM, 1), (PCM, 2), (PCM, 3), (PCM, 4),
+                                     (FLOAT, 4), (FLOAT, 8)):
+            raise ValueError('Unsupported wav encoding in ' + self.filename)
+        self.floating = tag == FLOAT
+        # Clip to the real file size in case the header overstates it
+        available = os.path.getsize(self.filename) - self.offset
+        self.frames = min(self.nbytes, available) // (self.width *
+                                                      self.channels)
+
+    @property
+    def raw(self):
+        """Memory-mapped view of the encoded sample data"""
+        if self.width == 3:
+            dtype = np.uint8
+            shape = (self.frames, self.channels, 3)
+        else:
+            dtype = {(1, False): np.uint8, (2, False): np.int16,
+                     (4, False): np.int32, (4, True): np.float32,
+                     (8, True): np.float64}[(self.width, self.floating)]
+            shape = (self.frames, self.channels)
+        return np.memmap(self.filename, dtype=dtype, mode='r',
+                         offset=self.offset, shape=shape)
+
+    @property
+    def samples(self):
+        """Decoded float32 samples, shared while anything holds them and
+        decoded again once they have all been released. A thread asking
+        while another is decoding waits for that decode"""
+        with self._lock:
+            samples = self._samples and self._samples()
+            if samples is None:
+                samples = self.decode()
+                self._samples = weakref.ref(samples)
+            return samples
+
+    def decode(self, start=0, stop=None):
+        """Decode frames start to stop (the whole file by default) to
+        float32 without keeping the result"""
+        raw = self.raw[start:stop]
+        if self.width == 3:
+            # Assemble little endian 24 bit samples into the top of an int32
+            packed = raw.astype(np.int32)
+            samples = ((packed[..., 0] << 8) | (packed[..., 1] << 16) |
+                       (packed[..., 2] << 24)).astype(np.float32)
+            samples /= 2 ** 31
+        else:
+            samples = raw.astype(np.float32)
+            if self.width == 1:
+                samples -= 128  # 8 bit wav data is unsigned
+            if not self.floating:
+                samples /= 2 ** (8 * self.width - 1)
+        if self.channels == 1:
+            samples = samples[:, 0]
+        return samples
+
+    @property
+    def duration(self):
+        return self.frames / self.rate
+
+
+def openWav(filename):
+    """Return the shared WavFile for a filename, reopening it if the file
+    has changed on disk"""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    with _registryLock:
+        wav = _registry.get(key)
+        if wav is None:
+            wav = WavFile(filename)
+            _registry[key] = wav
+    return wav